@@ -15,6 +15,8 @@ down_revision = None
 branch_labels = None
 depends_on = None
 
+HNSW_EF_SEARCH = 40
+
 
 def upgrade() -> None:
     op.execute("CREATE EXTENSION IF NOT EXISTS vector")
@@ -31,20 +33,33 @@ def upgrade() -> None:
         sa.Column("content", sa.Text(), nullable=False),
         sa.Column("embedding", Vector(768), nullable=False),
     )
+    # Keep vectors inline in the heap: no TOAST fetch or pglz decompression per scanned row.
+    op.execute("ALTER TABLE document_pages ALTER COLUMN embedding SET STORAGE MAIN")
     op.create_index("ix_document_pages_file_hash", "document_pages", ["file_hash"])
     op.create_index("ix_document_pages_company_name", "document_pages", ["company_name"])
     op.create_index("ix_document_pages_doc_type", "document_pages", ["doc_type"])
     op.create_index("ix_document_pages_fiscal_year", "document_pages", ["fiscal_year"])
     op.create_index("ix_document_pages_fiscal_quarter", "document_pages", ["fiscal_quarter"])
 
+    # HNSW needs no training step, so it can be built on the empty table.
     op.execute(
         "CREATE INDEX IF NOT EXISTS idx_document_pages_embedding "
-        "ON document_pages USING ivfflat (embedding vector_cosine_ops) "
-        "WITH (lists = 100)"
+        "ON document_pages USING hnsw (embedding vector_cosine_ops) "
+        "WITH (m = 16, ef_construction = 64)"
+    )
+    op.execute(
+        "DO $$ BEGIN EXECUTE format("
+        f"'ALTER DATABASE %I SET hnsw.ef_search = {HNSW_EF_SEARCH}', current_database()"
+        "); END $$"
     )
 
 
 def downgrade() -> None:
+    op.execute(
+        "DO $$ BEGIN EXECUTE format("
+        "'ALTER DATABASE %I RESET hnsw.ef_search', current_database()"
+        "); END $$"
+    )
     op.execute("DROP INDEX IF EXISTS idx_document_pages_embedding")
     op.drop_index("ix_document_pages_fiscal_quarter", table_name="document_pages")
     op.drop_index("ix_document_pages_fiscal_year", table_name="document_pages")
@@ -0,0 +1,25 @@
+"""store document_pages.embedding inline (STORAGE MAIN)
+
+SET STORAGE only affects newly written tuples; already ingested pages move
+their vectors out of TOAST when 005 rewrites the table for the halfvec type.
+
+Revision ID: 004_document_pages_embedding_storage
+Revises: 001_create_document_pages
+Create Date: 2026-10-15
+
+"""
+from alembic import op
+
+
+revision = "004_document_pages_embedding_storage"
+down_revision = "001_create_document_pages"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.execute("ALTER TABLE document_pages ALTER COLUMN embedding SET STORAGE MAIN")
+
+
+def downgrade() -> None:
+    op.execute("ALTER TABLE document_pages ALTER COLUMN embedding SET STORAGE EXTENDED")
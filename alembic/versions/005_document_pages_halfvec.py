@@ -0,0 +1,43 @@
+"""store document_pages.embedding as halfvec (FP16)
+
+Revision ID: 005_document_pages_halfvec
+Revises: 004_document_pages_embedding_storage
+Create Date: 2026-10-15
+
+"""
+from alembic import op
+
+
+revision = "005_document_pages_halfvec"
+down_revision = "004_document_pages_embedding_storage"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.execute("DROP INDEX IF EXISTS idx_document_pages_embedding")
+    op.execute(
+        "ALTER TABLE document_pages ALTER COLUMN embedding "
+        "TYPE halfvec(768) USING embedding::halfvec(768)"
+    )
+    # ALTER TYPE resets the column storage to the type default.
+    op.execute("ALTER TABLE document_pages ALTER COLUMN embedding SET STORAGE MAIN")
+    op.execute(
+        "CREATE INDEX idx_document_pages_embedding "
+        "ON document_pages USING hnsw (embedding halfvec_cosine_ops) "
+        "WITH (m = 16, ef_construction = 64)"
+    )
+
+
+def downgrade() -> None:
+    op.execute("DROP INDEX IF EXISTS idx_document_pages_embedding")
+    op.execute(
+        "ALTER TABLE document_pages ALTER COLUMN embedding "
+        "TYPE vector(768) USING embedding::vector(768)"
+    )
+    op.execute("ALTER TABLE document_pages ALTER COLUMN embedding SET STORAGE MAIN")
+    op.execute(
+        "CREATE INDEX idx_document_pages_embedding "
+        "ON document_pages USING hnsw (embedding vector_cosine_ops) "
+        "WITH (m = 16, ef_construction = 64)"
+    )
@@ -0,0 +1,59 @@
+"""add bulk-load helpers that drop and rebuild document_pages indexes
+
+``document_pages_bulk_load_begin()`` drops the embedding index and the metadata
+btree indexes so a large COPY does not maintain them row by row;
+``document_pages_bulk_load_end()`` rebuilds them over the loaded data. The
+file_hash index is kept because ingest checks it for every file.
+
+Revision ID: 006_document_pages_bulk_load
+Revises: 005_document_pages_halfvec
+Create Date: 2026-10-15
+
+"""
+from alembic import op
+
+
+revision = "006_document_pages_bulk_load"
+down_revision = "005_document_pages_halfvec"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.execute(
+        """
+        CREATE OR REPLACE FUNCTION document_pages_bulk_load_begin() RETURNS void
+        LANGUAGE plpgsql AS $$
+        BEGIN
+            DROP INDEX IF EXISTS idx_document_pages_embedding;
+            DROP INDEX IF EXISTS ix_document_pages_company_name;
+            DROP INDEX IF EXISTS ix_document_pages_doc_type;
+            DROP INDEX IF EXISTS ix_document_pages_fiscal_year;
+            DROP INDEX IF EXISTS ix_document_pages_fiscal_quarter;
+        END $$
+        """
+    )
+    op.execute(
+        """
+        CREATE OR REPLACE FUNCTION document_pages_bulk_load_end() RETURNS void
+        LANGUAGE plpgsql AS $$
+        BEGIN
+            CREATE INDEX IF NOT EXISTS ix_document_pages_company_name
+                ON document_pages (company_name);
+            CREATE INDEX IF NOT EXISTS ix_document_pages_doc_type
+                ON document_pages (doc_type);
+            CREATE INDEX IF NOT EXISTS ix_document_pages_fiscal_year
+                ON document_pages (fiscal_year);
+            CREATE INDEX IF NOT EXISTS ix_document_pages_fiscal_quarter
+                ON document_pages (fiscal_quarter);
+            CREATE INDEX IF NOT EXISTS idx_document_pages_embedding
+                ON document_pages USING hnsw (embedding halfvec_cosine_ops)
+                WITH (m = 16, ef_construction = 64);
+        END $$
+        """
+    )
+
+
+def downgrade() -> None:
+    op.execute("DROP FUNCTION IF EXISTS document_pages_bulk_load_end()")
+    op.execute("DROP FUNCTION IF EXISTS document_pages_bulk_load_begin()")
@@ -0,0 +1,74 @@
+"""add a composite metadata index for company/year/quarter filters
+
+The extracted filters usually combine company, year and quarter with the
+vector ORDER BY. A composite covering index serves the metadata part.
+
+Revision ID: 007_document_pages_filter_indexes
+Revises: 006_document_pages_bulk_load
+Create Date: 2026-10-15
+
+"""
+from alembic import op
+
+
+revision = "007_document_pages_filter_indexes"
+down_revision = "006_document_pages_bulk_load"
+branch_labels = None
+depends_on = None
+
+
+COMPOSITE_INDEX = (
+    "CREATE INDEX IF NOT EXISTS ix_document_pages_company_year_quarter "
+    "ON document_pages (company_name, fiscal_year, fiscal_quarter) "
+    "INCLUDE (id, page, source_file)"
+)
+
+
+def _create_bulk_load_functions(drop_extra: list[str], create_extra: list[str]) -> None:
+    drops = "".join(f"DROP INDEX IF EXISTS {name};\n" for name in drop_extra)
+    creates = "".join(f"{sql};\n" for sql in create_extra)
+    op.execute(
+        f"""
+        CREATE OR REPLACE FUNCTION document_pages_bulk_load_begin() RETURNS void
+        LANGUAGE plpgsql AS $$
+        BEGIN
+            DROP INDEX IF EXISTS idx_document_pages_embedding;
+            DROP INDEX IF EXISTS ix_document_pages_company_name;
+            DROP INDEX IF EXISTS ix_document_pages_doc_type;
+            DROP INDEX IF EXISTS ix_document_pages_fiscal_year;
+            DROP INDEX IF EXISTS ix_document_pages_fiscal_quarter;
+            {drops}
+        END $$
+        """
+    )
+    op.execute(
+        f"""
+        CREATE OR REPLACE FUNCTION document_pages_bulk_load_end() RETURNS void
+        LANGUAGE plpgsql AS $$
+        BEGIN
+            CREATE INDEX IF NOT EXISTS ix_document_pages_company_name
+                ON document_pages (company_name);
+            CREATE INDEX IF NOT EXISTS ix_document_pages_doc_type
+                ON document_pages (doc_type);
+            CREATE INDEX IF NOT EXISTS ix_document_pages_fiscal_year
+                ON document_pages (fiscal_year);
+            CREATE INDEX IF NOT EXISTS ix_document_pages_fiscal_quarter
+                ON document_pages (fiscal_quarter);
+            CREATE INDEX IF NOT EXISTS idx_document_pages_embedding
+                ON document_pages USING hnsw (embedding halfvec_cosine_ops)
+                WITH (m = 16, ef_construction = 64);
+            {creates}
+        END $$
+        """
+    )
+
+
+def upgrade() -> None:
+    op.execute(COMPOSITE_INDEX)
+    # Keep bulk loads from maintaining the new index row by row.
+    _create_bulk_load_functions(["ix_document_pages_company_year_quarter"], [COMPOSITE_INDEX])
+
+
+def downgrade() -> None:
+    _create_bulk_load_functions([], [])
+    op.execute("DROP INDEX IF EXISTS ix_document_pages_company_year_quarter")
@@ -0,0 +1,39 @@
+"""tune database-level I/O and parallelism settings for vector search
+
+Revision ID: 008_database_io_settings
+Revises: 007_document_pages_filter_indexes
+Create Date: 2026-10-15
+
+"""
+from alembic import op
+
+
+revision = "008_database_io_settings"
+down_revision = "007_document_pages_filter_indexes"
+branch_labels = None
+depends_on = None
+
+
+DATABASE_SETTINGS = {
+    "effective_io_concurrency": "200",
+    "max_parallel_workers_per_gather": "4",
+    "work_mem": "64MB",
+}
+
+
+def _alter_database(clause: str) -> None:
+    op.execute(
+        "DO $$ BEGIN EXECUTE format("
+        f"'ALTER DATABASE %I {clause}', current_database()"
+        "); END $$"
+    )
+
+
+def upgrade() -> None:
+    for name, value in DATABASE_SETTINGS.items():
+        _alter_database(f"SET {name} = ''{value}''")
+
+
+def downgrade() -> None:
+    for name in DATABASE_SETTINGS:
+        _alter_database(f"RESET {name}")
@@ -0,0 +1,31 @@
+"""add document_pages.term_freqs for keyword reranking
+
+Ingest stores each page's BM25 token counts so reranking no longer has to
+re-tokenize page content on every query. Pages ingested before this revision
+keep NULL and are tokenized on the fly.
+
+Revision ID: 009_document_pages_term_freqs
+Revises: 008_database_io_settings
+Create Date: 2026-10-15
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+revision = "009_document_pages_term_freqs"
+down_revision = "008_database_io_settings"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column(
+        "document_pages",
+        sa.Column("term_freqs", postgresql.JSONB(), nullable=True),
+    )
+
+
+def downgrade() -> None:
+    op.drop_column("document_pages", "term_freqs")
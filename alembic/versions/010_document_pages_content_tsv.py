@@ -0,0 +1,89 @@
+"""add a generated tsvector column with a GIN index for keyword prefiltering
+
+The keyword prefilter used ``content ILIKE '%kw%'``, which no index can serve,
+so every filtered search scanned the page text. A stored generated tsvector is
+maintained by Postgres on COPY/INSERT and matched through the GIN index. The
+bulk-load functions drop and rebuild the GIN index along with the others.
+
+Revision ID: 010_document_pages_content_tsv
+Revises: 009_document_pages_term_freqs
+Create Date: 2026-10-15
+
+"""
+from alembic import op
+
+
+revision = "010_document_pages_content_tsv"
+down_revision = "009_document_pages_term_freqs"
+branch_labels = None
+depends_on = None
+
+
+COMPOSITE_INDEX = (
+    "CREATE INDEX IF NOT EXISTS ix_document_pages_company_year_quarter "
+    "ON document_pages (company_name, fiscal_year, fiscal_quarter) "
+    "INCLUDE (id, page, source_file)"
+)
+
+CONTENT_TSV_INDEX = (
+    "CREATE INDEX IF NOT EXISTS ix_document_pages_content_tsv "
+    "ON document_pages USING gin (content_tsv)"
+)
+
+
+def _create_bulk_load_functions(drop_extra: list[str], create_extra: list[str]) -> None:
+    drops = "".join(f"DROP INDEX IF EXISTS {name};\n" for name in drop_extra)
+    creates = "".join(f"{sql};\n" for sql in create_extra)
+    op.execute(
+        f"""
+        CREATE OR REPLACE FUNCTION document_pages_bulk_load_begin() RETURNS void
+        LANGUAGE plpgsql AS $$
+        BEGIN
+            DROP INDEX IF EXISTS idx_document_pages_embedding;
+            DROP INDEX IF EXISTS ix_document_pages_company_name;
+            DROP INDEX IF EXISTS ix_document_pages_doc_type;
+            DROP INDEX IF EXISTS ix_document_pages_fiscal_year;
+            DROP INDEX IF EXISTS ix_document_pages_fiscal_quarter;
+            {drops}
+        END $$
+        """
+    )
+    op.execute(
+        f"""
+        CREATE OR REPLACE FUNCTION document_pages_bulk_load_end() RETURNS void
+        LANGUAGE plpgsql AS $$
+        BEGIN
+            CREATE INDEX IF NOT EXISTS ix_document_pages_company_name
+                ON document_pages (company_name);
+            CREATE INDEX IF NOT EXISTS ix_document_pages_doc_type
+                ON document_pages (doc_type);
+            CREATE INDEX IF NOT EXISTS ix_document_pages_fiscal_year
+                ON document_pages (fiscal_year);
+            CREATE INDEX IF NOT EXISTS ix_document_pages_fiscal_quarter
+                ON document_pages (fiscal_quarter);
+            CREATE INDEX IF NOT EXISTS idx_document_pages_embedding
+                ON document_pages USING hnsw (embedding halfvec_cosine_ops)
+                WITH (m = 16, ef_construction = 64);
+            {creates}
+        END $$
+        """
+    )
+
+
+def upgrade() -> None:
+    op.execute(
+        "ALTER TABLE document_pages ADD COLUMN IF NOT EXISTS content_tsv tsvector "
+        "GENERATED ALWAYS AS (to_tsvector('english', content)) STORED"
+    )
+    op.execute(CONTENT_TSV_INDEX)
+    # Bulk loads must not maintain the GIN index row by row either.
+    _create_bulk_load_functions(
+        ["ix_document_pages_company_year_quarter", "ix_document_pages_content_tsv"],
+        [COMPOSITE_INDEX, CONTENT_TSV_INDEX],
+    )
+
+
+def downgrade() -> None:
+    _create_bulk_load_functions(["ix_document_pages_company_year_quarter"], [COMPOSITE_INDEX])
+    op.execute("DROP INDEX IF EXISTS ix_document_pages_content_tsv")
+    op.execute("ALTER TABLE document_pages DROP COLUMN IF EXISTS content_tsv")
@@ -1,229 +1,345 @@
-import time
-from typing import List, Dict, Any
+import asyncio
+import logging
+import re
+from typing import List, Dict, Any, AsyncIterator, Awaitable, Optional, Tuple, TypeVar
 
+import httpx
 from langchain_ollama import ChatOllama
+from ollama import ResponseError
 from langchain_core.messages import HumanMessage, SystemMessage
 from langchain_core.exceptions import OutputParserException
+from pydantic import ValidationError
 
 from app.config import settings
 from app.llm_schemas import (
     ChunkMetadata,
-    RankingKeywords,
-    SearchQueries,
+    BatchSubQueryPlan,
+    QueryAnalysis,
     QueryScope,
+    SubQueryPlan,
     GradeDecision,
     RewriteQuery,
     ReflexionAnswer,
+    ReflexionFooter,
 )
-from app.logger import setup_logger
+from app.context_budget import answer_budget_tokens, estimate_tokens, fit_retrieved_docs
+from app.json_fast import with_fast_structured_output
+from app.llm_cache import cached_llm_call
+from app.logger import setup_logger, timed
 
 
 logger = setup_logger(__name__)
+
+T = TypeVar("T")
 llm = ChatOllama(
     model=settings.OLLAMA_LLM_MODEL,
     base_url=settings.OLLAMA_BASE_URL,
     reasoning=settings.OLLAMA_REASONING,
+    keep_alive=settings.OLLAMA_KEEP_ALIVE,
+    client_kwargs={
+        "timeout": settings.OLLAMA_TIMEOUT,
+        "limits": httpx.Limits(
+            max_keepalive_connections=settings.OLLAMA_MAX_KEEPALIVE_CONNECTIONS,
+            max_connections=settings.OLLAMA_MAX_CONNECTIONS,
+        ),
+    },
+)
+# Failures that fall back to a default answer; anything else is a bug and propagates.
+_LLM_ERRORS = (
+    OutputParserException,
+    ValidationError,
+    ResponseError,
+    httpx.HTTPError,
+    ConnectionError,
+    TimeoutError,
 )
+# Caps in-flight async LLM requests at what the Ollama server runs in parallel.
+_LLM_SEMAPHORE = asyncio.Semaphore(settings.OLLAMA_NUM_PARALLEL)
+
+
+async def _bounded_llm_call(call: Awaitable[T]) -> T:
+    async with _LLM_SEMAPHORE:
+        return await asyncio.wait_for(call, settings.LLM_TIMEOUT)
+
+
+def _llm_options(num_predict: int, temperature: float = 0) -> Dict[str, Any]:
+    return {
+        "num_predict": num_predict,
+        "temperature": temperature,
+        "num_ctx": settings.OLLAMA_CONTEXT_LENGTH,
+        "num_keep": -1,
+    }
+
+
+_LLM_ANALYSIS = with_fast_structured_output(llm, QueryAnalysis)
+_LLM_GRADE = with_fast_structured_output(llm, GradeDecision)
+_LLM_REWRITE = with_fast_structured_output(llm, RewriteQuery)
+_LLM_PLAN = with_fast_structured_output(llm, BatchSubQueryPlan)
+
+EMPTY_ANSWER = "Не удалось сформировать ответ. Попробуйте уточнить запрос."
+REFLEXION_FOOTER_MARKER = "<<<REFLEXION_JSON>>>"
+
+
+# One byte-identical system prefix for every structured agent call, so Ollama can
+# reuse its KV cache across tasks; only the trailing HumanMessage differs.
+_AGENT_SYSTEM_PROMPT = """Ты модуль финансового RAG-агента. Каждое сообщение начинается со строки
+"TASK: <имя задачи>". Выполни только указанную задачу по её правилам ниже и ответь ОДНИМ JSON-объектом.
+
+########## TASK: analyze_query ##########
+Проанализируй запрос пользователя и выполни четыре задачи.
+
+=== ЗАДАЧА 1: scope ===
+Определи, относится ли запрос к финансовым данным компаний из SEC-отчётности (10-K/10-Q/8-K).
+Примеры in_scope: "Выручка Google в 2024 году", "Amazon operating income Q3 2023"
+Примеры out_of_scope: "Привет как дела", "Погода в Москве", "Сколько будет 2+2"
+
+=== ЗАДАЧА 2: filters ===
+Извлеки метаданные. Для неупомянутых полей верни null.
+СООТВЕТСТВИЯ КОМПАНИЙ:
+- Amazon/AMZN -> amazon
+- Google/Alphabet/GOOGL/GOOG -> google
+- Apple/AAPL -> apple
+- Microsoft/MSFT -> microsoft
+- Tesla/TSLA -> tesla
+- Nvidia/NVDA -> nvidia
+- Meta/Facebook/FB -> meta
+ТИП ДОКУМЕНТА:
+- Annual report -> 10-k
+- Quarterly report -> 10-q
+- Current report -> 8-k
+
+=== ЗАДАЧА 3: subqueries ===
+Разбей запрос на 1–3 конкретных поисковых запроса, каждый про одну компанию,
+конкретный период и конкретную метрику. Раскрывай сокращения ("rev" -> "revenue",
+"GOOGL" -> "Google"). Держи запросы краткими (5–10 слов).
+
+=== ЗАДАЧА 4: keywords ===
+Сгенерируй РОВНО 5 финансовых ключевых фраз в точной терминологии отчётности SEC
+("consolidated statements of operations", "revenue", "net income", "total assets",
+"cash flows from operating activities", "stockholders equity" и т.п.),
+соответствующих теме запроса.
+
+СХЕМА ОТВЕТА:
+{
+  "scope": {"in_scope": true, "reason": "..."},
+  "filters": {"company_name": "amazon", "doc_type": "10-q", "fiscal_year": 2024, "fiscal_quarter": "q3"},
+  "subqueries": ["Amazon revenue Q3 2024"],
+  "keywords": ["revenue", "net revenue", "total revenue", "consolidated statements of operations", "net sales"]
+}
 
+########## TASK: plan_subqueries ##########
+Для КАЖДОГО поискового запроса из списка выполни ЗАДАЧУ 2 (filters) и ЗАДАЧУ 4 (keywords)
+из analyze_query. Верни элементы в том же порядке, что и запросы.
 
-def extract_filters(user_query: str) -> Dict[str, Any]:
-    start_time = time.time()
-    logger.debug(f"[extract_filters] Input query: {user_query}")
-    
-    llm_structured = llm.with_structured_output(ChunkMetadata)
-    prompt = f"""Извлеки метаданные из запроса. Для неупомянутых полей верни None.
+СХЕМА ОТВЕТА:
+{
+  "items": [
+    {
+      "query": "Amazon revenue Q3 2024",
+      "filters": {"company_name": "amazon", "doc_type": "10-q", "fiscal_year": 2024, "fiscal_quarter": "q3"},
+      "keywords": ["revenue", "net revenue", "total revenue", "consolidated statements of operations", "net sales"]
+    }
+  ]
+}
 
-    ЗАПРОС ПОЛЬЗОВАТЕЛЯ: {user_query}
+########## TASK: grade_documents ##########
+You are a document relevance grader.
+Evaluate if the retrieved documents are relevant to answer the user's question.
 
-    СООТВЕТСТВИЯ КОМПАНИЙ:
-    - Amazon/AMZN -> amazon
-    - Google/Alphabet/GOOGL/GOOG -> google
-    - Apple/AAPL -> apple
-    - Microsoft/MSFT -> microsoft
-    - Tesla/TSLA -> tesla
-    - Nvidia/NVDA -> nvidia
-    - Meta/Facebook/FB -> meta
+CRITERIA:
+- is_relevant = True: Documents contain information that can answer the question
+- is_relevant = False: Documents are completely irrelevant, off-topic, or empty
 
-    ТИП ДОКУМЕНТА:
-    - Annual report -> 10-k
-    - Quarterly report -> 10-q
-    - Current report -> 8-k
+Respond ONLY with {"is_relevant": true} or {"is_relevant": false}. No explanation.
 
-    ПРИМЕРЫ:
-    "Amazon Q3 2024 revenue" -> {{"company_name": "amazon", "doc_type": "10-q", "fiscal_year": 2024, "fiscal_quarter": "q3"}}
-    "Apple 2023 annual report" -> {{"company_name": "apple", "doc_type": "10-k", "fiscal_year": 2023}}
-    "Tesla profitability" -> {{"company_name": "tesla"}}
+########## TASK: rewrite_query ##########
+You are a query rewriting expert.
+Rewrite the user's question to make it more specific and targeted for document retrieval.
 
-    Извлеки метаданные:
-    """
+INSTRUCTIONS:
+- Make the query more specific with keywords
+- Add relevant financial terms (revenue, profit, earnings, cash flow, etc.)
+- Preserve the original intent
+- Keep it concise (5-12 words)
 
-    try:
-        metadata = llm_structured.invoke(
-            prompt,
-            options={
-                "num_predict": settings.OLLAMA_NUM_PREDICT,
-                "temperature": 0,
-                "num_ctx": settings.OLLAMA_CONTEXT_LENGTH,
-            },
-            format="json",
-        )
-        result = metadata.model_dump(exclude_none=True)
-        elapsed = time.time() - start_time
-        logger.info(f"[extract_filters] Extracted filters in {elapsed:.2f}s: {result}")
-        return result
-    except (OutputParserException, Exception) as e:
-        elapsed = time.time() - start_time
-        logger.warning(f"[extract_filters] Failed in {elapsed:.2f}s: {e}")
-        return {}
-
-
-def classify_query_scope(user_query: str) -> QueryScope:
-    start_time = time.time()
-    logger.debug(f"[classify_query_scope] Input query: {user_query}")
-
-    llm_structured = llm.with_structured_output(QueryScope)
-    prompt = f"""Определи, относится ли запрос к финансовым данным компаний из SEC-отчётности (10-K/10-Q/8-K).
-Ответь ТОЛЬКО в JSON со схемой:
-{{"in_scope": boolean, "reason": string|null}}
-
-Примеры in_scope:
-- "Выручка Google в 2024 году"
-- "Amazon operating income Q3 2023"
-- "cash flows from operating activities Microsoft 2022"
-
-Примеры out_of_scope:
-- "Привет как дела"
-- "Погода в Москве"
-- "Сколько будет 2+2"
-
-ЗАПРОС: {user_query}
+Return ONLY in JSON with this schema:
+{"rewritten_query": "..."}
 """
+_SYS_AGENT = SystemMessage(_AGENT_SYSTEM_PROMPT)
+
+_ANALYZE_QUERY_PROMPT = "TASK: analyze_query\nЗАПРОС ПОЛЬЗОВАТЕЛЯ: {user_query}"
+_PLAN_SUBQUERIES_PROMPT = "TASK: plan_subqueries\nПОИСКОВЫЕ ЗАПРОСЫ:\n{sub_queries}"
+
+
+_COMPANY_ALIASES = {
+    "amazon": "amazon",
+    "amzn": "amazon",
+    "google": "google",
+    "alphabet": "google",
+    "googl": "google",
+    "goog": "google",
+    "apple": "apple",
+    "aapl": "apple",
+    "microsoft": "microsoft",
+    "msft": "microsoft",
+    "tesla": "tesla",
+    "tsla": "tesla",
+    "nvidia": "nvidia",
+    "nvda": "nvidia",
+    "meta": "meta",
+    "facebook": "meta",
+    "fb": "meta",
+}
+_COMPANY_RE = re.compile(
+    r"\b(" + "|".join(sorted(_COMPANY_ALIASES, key=len, reverse=True)) + r")\b", re.IGNORECASE
+)
+_DOC_TYPE_RE = re.compile(r"\b(10-k|10-q|8-k)\b", re.IGNORECASE)
+_QUARTER_RE = re.compile(r"\b(q[1-4])\b", re.IGNORECASE)
+_YEAR_RE = re.compile(r"\b(19[5-9]\d|20[0-4]\d|2050)\b")
+# Only a message that is nothing but a greeting; "hi-tech" or "Hi, what was AAPL
+# revenue?" must still reach the LLM.
+_OUT_OF_SCOPE_RE = re.compile(
+    r"\s*(привет|здравствуй\w*|добрый (?:день|вечер)|как дела|hello|hi|hey)[\W_]*",
+    re.IGNORECASE,
+)
+_ARITHMETIC_RE = re.compile(r"\s*\d+(?:\.\d+)?\s*[+\-*/]\s*\d+(?:\.\d+)?[\s=?]*")
 
-    try:
-        result = llm_structured.invoke(
-            prompt,
-            options={
-                "num_predict": 64,
-                "temperature": 0,
-                "num_ctx": settings.OLLAMA_CONTEXT_LENGTH,
-            },
-            format="json",
-        )
-        elapsed = time.time() - start_time
-        logger.info(
-            f"[classify_query_scope] in_scope={result.in_scope} in {elapsed:.2f}s reason={result.reason}"
-        )
-        return result
-    except (OutputParserException, Exception) as e:
-        elapsed = time.time() - start_time
-        logger.warning(f"[classify_query_scope] Failed in {elapsed:.2f}s: {e}")
-        return QueryScope(in_scope=True, reason="fallback_allow")
 
+def _regex_filters(user_query: str) -> ChunkMetadata:
+    # Only unambiguous matches: a field is set when exactly one distinct value is found.
+    def single(pattern: re.Pattern, normalize=str.lower):
+        values = {normalize(m) for m in pattern.findall(user_query)}
+        return values.pop() if len(values) == 1 else None
 
-def generate_ranking_keywords(user_query: str) -> List[str]:
-    start_time = time.time()
-    logger.debug(f"[generate_ranking_keywords] Input query: {user_query}")
-    
-    prompt = f"""
-    Сгенерируй РОВНО 5 финансовых ключевых фраз на терминологии отчётности SEC.
+    return ChunkMetadata(
+        company_name=single(_COMPANY_RE, lambda m: _COMPANY_ALIASES[m.lower()]),
+        doc_type=single(_DOC_TYPE_RE),
+        fiscal_year=single(_YEAR_RE, int),
+        fiscal_quarter=single(_QUARTER_RE),
+    )
 
-    ЗАПРОС ПОЛЬЗОВАТЕЛЯ: {user_query}
 
-    ИСПОЛЬЗУЙ ТОЧНЫЕ ТЕРМИНЫ ИЗ ОТЧЁТОВ 10-K/10-Q:
+def _fast_out_of_scope(user_query: str) -> Optional[QueryAnalysis]:
+    if _ARITHMETIC_RE.fullmatch(user_query):
+        reason = "arithmetic"
+    elif _OUT_OF_SCOPE_RE.fullmatch(user_query):
+        reason = "small_talk"
+    else:
+        return None
+    logger.info("[analyze_query] Out of scope by fast path (%s): %s", reason, user_query)
+    return QueryAnalysis(
+        scope=QueryScope(in_scope=False, reason=reason),
+        subqueries=[user_query],
+    )
 
-    ЗАГОЛОВКИ ОТЧЁТНОСТИ:
-    "consolidated statements of operations", "consolidated balance sheets", "consolidated statements of cash flows", "consolidated statements of stockholders equity"
 
-    ОТЧЁТ О ПРИБЫЛЯХ И УБЫТКАХ:
-    "revenue", "net revenue", "cost of revenue", "gross profit", "operating income", "net income", "earnings per share"
+def _fallback_analysis(user_query: str) -> QueryAnalysis:
+    return QueryAnalysis(
+        scope=QueryScope(in_scope=True, reason="fallback_allow"),
+        filters=_regex_filters(user_query),
+        subqueries=[user_query],
+        keywords=[],
+    )
 
-    БАЛАНС:
-    "total assets", "cash and cash equivalents", "total liabilities", "stockholders equity", "working capital", "long-term debt"
 
-    ДЕНЕЖНЫЕ ПОТОКИ:
-    "cash flows from operating activities", "net cash provided by operating activities", "cash flows from investing activities", "free cash flow", "capital expenditures"
+def _apply_regex_filters(user_query: str, filters: ChunkMetadata) -> None:
+    # An unambiguous mention in the query wins over whatever the model returned.
+    for field, value in _regex_filters(user_query).model_dump(exclude_none=True).items():
+        setattr(filters, field, value)
 
-    ПРАВИЛА:
-    - Верни РОВНО 5 ключевых фраз
-    - Используй точные формулировки из отчётности SEC
-    - Соответствуй теме запроса (revenue -> термины выручки, cash -> термины cash flow)
-    - Используй "cash flows" (во мн. числе) и "stockholders equity"
 
-    ПРИМЕРЫ:
-    "revenue analysis" -> ["revenue", "net revenue", "total revenue", "consolidated statements of operations", "net sales"]
-    "cash flow performance" -> ["consolidated statements of cash flows", "cash flows from operating activities", "net cash provided by operating activities", "free cash flow", "operating activities"]
-    "balance sheet strength" -> ["consolidated balance sheets", "total assets", "stockholders equity", "cash and cash equivalents", "long-term debt"]
+def _parse_analysis(user_query: str, analysis: QueryAnalysis) -> QueryAnalysis:
+    if len(user_query.split()) < settings.DECOMPOSE_MIN_WORDS:
+        analysis.subqueries = [user_query]
+    else:
+        analysis.subqueries = analysis.subqueries[: settings.MAX_SUB_QUERIES] or [user_query]
+    _apply_regex_filters(user_query, analysis.filters)
+    return analysis
 
-    Сгенерируй РОВНО 5 ключевых фраз:
-    """
 
-    llm_structured = llm.with_structured_output(RankingKeywords)
+async def aanalyze_query(user_query: str) -> QueryAnalysis:
+    logger.debug("[analyze_query] Input query: %s", user_query)
+    fast = _fast_out_of_scope(user_query)
+    if fast is not None:
+        return fast
+
     try:
-        result = llm_structured.invoke(
-            prompt,
-            options={
-                "num_predict": settings.OLLAMA_NUM_PREDICT,
-                "temperature": 0,
-                "num_ctx": settings.OLLAMA_CONTEXT_LENGTH,
-            },
-            format="json",
-        )
-        elapsed = time.time() - start_time
-        logger.info(f"[generate_ranking_keywords] Generated {len(result.keywords)} keywords in {elapsed:.2f}s: {result.keywords}")
-        return result.keywords
-    except (OutputParserException, Exception) as e:
-        elapsed = time.time() - start_time
-        logger.warning(f"[generate_ranking_keywords] Failed in {elapsed:.2f}s: {e}")
+        with timed(logger, "analyze_query", logging.INFO) as timer:
+            analysis = await cached_llm_call(
+                "analyze_query",
+                user_query,
+                lambda: _bounded_llm_call(
+                    _LLM_ANALYSIS.ainvoke(
+                        [_SYS_AGENT, HumanMessage(_ANALYZE_QUERY_PROMPT.format(user_query=user_query))],
+                        options=_llm_options(settings.OLLAMA_NUM_PREDICT * 2),
+                        format="json",
+                    ),
+                ),
+                QueryAnalysis,
+            )
+            analysis = _parse_analysis(user_query, analysis)
+            timer.describe(
+                "in_scope=%s filters=%s subqueries=%s keywords=%s",
+                analysis.scope.in_scope,
+                analysis.filters.model_dump(exclude_none=True),
+                analysis.subqueries,
+                analysis.keywords,
+            )
+            return analysis
+    except _LLM_ERRORS as e:
+        logger.warning("[analyze_query] Failed in %.2fs: %s", timer.elapsed, e)
+        return _fallback_analysis(user_query)
+
+
+async def aplan_subqueries(sub_queries: List[str]) -> List[SubQueryPlan]:
+    """Filters and keywords for all sub-queries in one LLM call; [] on failure."""
+    logger.debug("[plan_subqueries] Sub-queries: %s", sub_queries)
+    numbered = "\n".join(f"{i}. {query}" for i, query in enumerate(sub_queries, 1))
+
+    try:
+        with timed(logger, "plan_subqueries", logging.INFO) as timer:
+            plan = await cached_llm_call(
+                "plan_subqueries",
+                "\n".join(sub_queries),
+                lambda: _bounded_llm_call(
+                    _LLM_PLAN.ainvoke(
+                        [_SYS_AGENT, HumanMessage(_PLAN_SUBQUERIES_PROMPT.format(sub_queries=numbered))],
+                        options=_llm_options(settings.OLLAMA_NUM_PREDICT * 2),
+                        format="json",
+                    ),
+                ),
+                BatchSubQueryPlan,
+            )
+            timer.describe("%d plans for %d sub-queries", len(plan.items), len(sub_queries))
+    except _LLM_ERRORS as e:
+        logger.warning("[plan_subqueries] Failed in %.2fs: %s", timer.elapsed, e)
         return []
 
+    if len(plan.items) != len(sub_queries):
+        logger.warning("[plan_subqueries] Plan count mismatch, ignoring")
+        return []
+    for item, query in zip(plan.items, sub_queries):
+        item.query = query
+        _apply_regex_filters(query, item.filters)
+    return plan.items
 
-def decompose_query(user_query: str) -> List[str]:
-    start_time = time.time()
-    logger.debug(f"[decompose_query] Input query: {user_query}")
-    
-    llm_structured = llm.with_structured_output(SearchQueries)
-    system_prompt = """
-    Ты редактор запросов, который разбивает сложные запросы на фокусированные поисковые запросы для векторного хранилища.
-
-    СТРАТЕГИЯ ДЕКОМПОЗИЦИИ:
-    Разбей исходный запрос на 1–3 конкретных и фокусированных запроса, где каждый запрос нацелен на:
-    - Одну компанию
-    - Конкретный период времени
-    - Конкретную метрику или аспект
-
-    ПРАВИЛА:
-    - Раскрывай сокращения (например, "rev" -> "revenue", "GOOGL" -> "Google")
-    - Делай каждый запрос самодостаточным и конкретным
-    - Держи запросы краткими (5–10 слов)
-    """
 
-    messages = [SystemMessage(system_prompt), HumanMessage(f"Исходный запрос: {user_query}")]
+async def awarm_up_llm() -> None:
+    # Loads the model and prefills the shared agent system prefix into Ollama's
+    # KV cache, so the first real request only prefills its own suffix.
     try:
-        response = llm_structured.invoke(
-            messages,
-            options={
-                "num_predict": settings.OLLAMA_NUM_PREDICT,
-                "temperature": 0,
-                "num_ctx": settings.OLLAMA_CONTEXT_LENGTH,
-            },
-            format="json",
-        )
-        queries = response.search_queries[: settings.MAX_SUB_QUERIES]
-        result = queries if queries else [user_query]
-        elapsed = time.time() - start_time
-        logger.info(f"[decompose_query] Decomposed into {len(result)} queries in {elapsed:.2f}s: {result}")
-        return result
-    except (OutputParserException, Exception) as e:
-        elapsed = time.time() - start_time
-        logger.warning(f"[decompose_query] Failed in {elapsed:.2f}s, returning original query: {e}")
-        return [user_query]
-
-
-def generate_answer(user_query: str, retrieved_docs: str) -> str:
-    start_time = time.time()
-    logger.debug(f"[generate_answer] Input query: {user_query}, docs length: {len(retrieved_docs)} chars")
-    
-    system_prompt = f"""Ты финансовый аналитик. Отвечай строго на основе предоставленных документов.
+        with timed(logger, "warm_up_llm", logging.INFO):
+            await _bounded_llm_call(
+                llm.ainvoke(
+                    [_SYS_AGENT, HumanMessage("TASK: warm_up")],
+                    options=_llm_options(1),
+                )
+            )
+    except _LLM_ERRORS as e:
+        logger.warning("[warm_up_llm] Failed: %s", e)
+
+
+_GENERATE_ANSWER_SYSTEM_PROMPT = """Ты финансовый аналитик. Отвечай строго на основе предоставленных документов.
 
     Требования:
     - Ответ на русском языке
@@ -231,131 +347,239 @@ def generate_answer(user_query: str, retrieved_docs: str) -> str:
     - Для сравнений выводи таблицы
     - Если данных нет, честно скажи об этом
     """
+_SYS_GENERATE = SystemMessage(_GENERATE_ANSWER_SYSTEM_PROMPT)
 
-    user_prompt = f"Вопрос пользователя: {user_query}\n\nДокументы:\n{retrieved_docs}"
-    logger.debug(f"[generate_answer] Prompt length: {len(user_prompt)} chars")
-    messages = [SystemMessage(system_prompt), HumanMessage(user_prompt)]
-    response = llm.invoke(
-        messages,
-        options={
-            "num_predict": settings.OLLAMA_NUM_PREDICT,
-            "temperature": 0.2,
-            "num_ctx": settings.OLLAMA_CONTEXT_LENGTH,
-        },
-    )
-    content = response.content or ""
-    logger.debug(f"[generate_answer] Response content repr: {content!r}")
-    logger.debug(
-        f"[generate_answer] Response metadata: {getattr(response, 'response_metadata', {})}"
-    )
-    logger.debug(
-        f"[generate_answer] Response additional_kwargs: {getattr(response, 'additional_kwargs', {})}"
-    )
-    logger.debug(f"[generate_answer] Response tool_calls: {getattr(response, 'tool_calls', None)}")
+
+_ANSWER_OPTIONS = _llm_options(settings.OLLAMA_NUM_PREDICT, temperature=0.2)
+
+
+def _answer_messages(user_query: str, retrieved_docs: str) -> list:
     logger.debug(
-        f"[generate_answer] Response usage_metadata: {getattr(response, 'usage_metadata', {})}"
+        "[generate_answer] Input query: %s, docs length: %d chars",
+        user_query,
+        len(retrieved_docs),
     )
+    retrieved_docs = fit_retrieved_docs(retrieved_docs, answer_budget_tokens())
+
+    user_prompt = f"Вопрос пользователя: {user_query}\n\nДокументы:\n{retrieved_docs}"
+    logger.debug("[generate_answer] Prompt length: %d chars", len(user_prompt))
+    return [_SYS_GENERATE, HumanMessage(user_prompt)]
+
+
+def _log_answer(content: str, last_chunk: Any) -> bool:
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("[generate_answer] Response content repr: %r", content)
+        logger.debug(
+            "[generate_answer] Response metadata: %s",
+            getattr(last_chunk, 'response_metadata', {}),
+        )
+        logger.debug(
+            "[generate_answer] Response usage_metadata: %s",
+            getattr(last_chunk, 'usage_metadata', {}),
+        )
     if not content.strip():
         logger.warning("[generate_answer] LLM returned empty content")
-        return "Не удалось сформировать ответ. Попробуйте уточнить запрос."
-    
-    elapsed = time.time() - start_time
-    logger.info(f"[generate_answer] Generated answer in {elapsed:.2f}s, length: {len(content)} chars")
-    logger.debug(f"[generate_answer] Answer content:\n{content}")
-    return content
+        return False
+
+    logger.debug("[generate_answer] Answer content:\n%s", content)
+    return True
+
+
+async def agenerate_answer(user_query: str, retrieved_docs: str) -> AsyncIterator[str]:
+    messages = _answer_messages(user_query, retrieved_docs)
+    parts = []
+    last_chunk = None
+    try:
+        with timed(logger, "generate_answer", logging.INFO) as timer:
+            async with _LLM_SEMAPHORE:
+                # One deadline for the whole stream, not per chunk. aclose() on client
+                # disconnect unwinds both blocks, so the semaphore slot is released.
+                async with asyncio.timeout(settings.LLM_TIMEOUT):
+                    async for chunk in llm.astream(messages, options=_ANSWER_OPTIONS):
+                        last_chunk = chunk
+                        text = chunk.content or ""
+                        if not text:
+                            continue
+                        parts.append(text)
+                        yield text
+            timer.describe("%d chars", sum(map(len, parts)))
+    except _LLM_ERRORS as e:
+        logger.warning("[generate_answer] Failed in %.2fs: %s", timer.elapsed, e)
+
+    if not _log_answer("".join(parts), last_chunk):
+        yield EMPTY_ANSWER
+
+
+_GRADE_DOCUMENTS_PROMPT = (
+    "TASK: grade_documents\nUSER QUESTION: {user_query}\n\n"
+    "RETRIEVED DOCUMENTS:\n{retrieved_docs}"
+)
 
 
-def grade_documents(user_query: str, retrieved_docs: str) -> GradeDecision:
-    start_time = time.time()
+async def _allm_grade_documents(user_query: str, retrieved_docs: str) -> GradeDecision:
     logger.debug(
-        f"[grade_documents] Input query: {user_query}, docs length: {len(retrieved_docs)} chars"
+        "[grade_documents] Input query: %s, docs length: %d chars",
+        user_query,
+        len(retrieved_docs),
     )
+    retrieved_docs = fit_retrieved_docs(retrieved_docs, settings.GRADE_CONTEXT_TOKENS)
 
-    llm_structured = llm.with_structured_output(GradeDecision)
-    prompt = f"""You are a document relevance grader.
+    try:
+        with timed(logger, "grade_documents", logging.INFO) as timer:
+            result = await cached_llm_call(
+                "grade_documents",
+                f"{user_query}\n\n{retrieved_docs}",
+                lambda: _bounded_llm_call(
+                    _LLM_GRADE.ainvoke(
+                        [
+                            _SYS_AGENT,
+                            HumanMessage(
+                                _GRADE_DOCUMENTS_PROMPT.format(
+                                    user_query=user_query, retrieved_docs=retrieved_docs
+                                )
+                            ),
+                        ],
+                        options=_llm_options(16),
+                        format="json",
+                    ),
+                ),
+                GradeDecision,
+            )
+            timer.describe("is_relevant=%s reason=%s", result.is_relevant, result.reasoning)
+    except _LLM_ERRORS as e:
+        logger.warning("[grade_documents] Failed in %.2fs: %s", timer.elapsed, e)
+        return GradeDecision(is_relevant=True, reasoning="fallback_allow")
+    return result
 
-TASK: Evaluate if the retrieved documents are relevant to answer the user's question.
 
-USER QUESTION: {user_query}
+def _similarity_grade(retrieved: List[Tuple[str, float]]) -> GradeDecision:
+    if not retrieved:
+        return GradeDecision(is_relevant=False, reasoning="no_documents")
+    max_sim = 1 - min(distance for _, distance in retrieved)
+    return GradeDecision(
+        is_relevant=bool(max_sim >= 1 - settings.GRADE_THRESHOLD),
+        reasoning=f"max_cos_sim={max_sim:.3f}",
+    )
 
-RETRIEVED DOCUMENTS:
-{retrieved_docs}
 
-CRITERIA:
-- is_relevant = True: Documents contain information that can answer the question
-- is_relevant = False: Documents are completely irrelevant, off-topic, or empty
+def _is_borderline(retrieved: List[Tuple[str, float]]) -> bool:
+    if not settings.GRADE_LLM_FALLBACK or not retrieved:
+        return False
+    min_distance = min(distance for _, distance in retrieved)
+    return abs(min_distance - settings.GRADE_THRESHOLD) < settings.GRADE_LLM_MARGIN
 
-Respond ONLY in JSON with this schema:
-{{"is_relevant": true/false, "reasoning": "brief explanation"}}
-"""
-    try:
-        result = llm_structured.invoke(
-            prompt,
-            options={
-                "num_predict": 128,
-                "temperature": 0,
-                "num_ctx": settings.OLLAMA_CONTEXT_LENGTH,
-            },
-            format="json",
-        )
-        elapsed = time.time() - start_time
-        logger.info(
-            f"[grade_documents] is_relevant={result.is_relevant} in {elapsed:.2f}s reason={result.reasoning}"
+
+async def agrade_documents(
+    user_query: str, retrieved: List[Tuple[str, float]]
+) -> GradeDecision:
+    if _is_borderline(retrieved):
+        return await _allm_grade_documents(
+            user_query, "\n\n".join(c for c, _ in retrieved)
         )
-        return result
-    except (OutputParserException, Exception) as e:
-        elapsed = time.time() - start_time
-        logger.warning(f"[grade_documents] Failed in {elapsed:.2f}s: {e}")
-        return GradeDecision(is_relevant=True, reasoning="fallback_allow")
+    decision = _similarity_grade(retrieved)
+    logger.info(
+        "[grade_documents] is_relevant=%s reason=%s",
+        decision.is_relevant,
+        decision.reasoning,
+    )
+    return decision
 
 
-def rewrite_query(user_query: str) -> str:
-    start_time = time.time()
-    logger.debug(f"[rewrite_query] Input query: {user_query}")
+_REWRITE_QUERY_PROMPT = "TASK: rewrite_query\nORIGINAL QUESTION: {user_query}"
 
-    llm_structured = llm.with_structured_output(RewriteQuery)
-    prompt = f"""You are a query rewriting expert.
 
-TASK: Rewrite the user's question to make it more specific and targeted for document retrieval.
+def _has_strong_filters(filters: Optional[Dict[str, Any]]) -> bool:
+    return bool(filters) and sum(1 for v in filters.values() if v) >= settings.REWRITE_SKIP_MIN_FILTERS
 
-ORIGINAL QUESTION: {user_query}
 
-INSTRUCTIONS:
-- Make the query more specific with keywords
-- Add relevant financial terms (revenue, profit, earnings, cash flow, etc.)
-- Preserve the original intent
-- Keep it concise (5-12 words)
+async def arewrite_query(user_query: str, filters: Optional[Dict[str, Any]] = None) -> str:
+    logger.debug("[rewrite_query] Input query: %s", user_query)
+    if _has_strong_filters(filters):
+        logger.info("[rewrite_query] Skipped, query already has filters: %s", filters)
+        return user_query
 
-Return ONLY in JSON with this schema:
-{{"rewritten_query": "..."}}"""
     try:
-        response = llm_structured.invoke(
-            prompt,
-            options={
-                "num_predict": 64,
-                "temperature": 0,
-                "num_ctx": settings.OLLAMA_CONTEXT_LENGTH,
-            },
-            format="json",
-        )
-        rewritten = response.rewritten_query.strip()
-        elapsed = time.time() - start_time
-        logger.info(f"[rewrite_query] Rewritten in {elapsed:.2f}s: {rewritten}")
-        return rewritten or user_query
-    except (OutputParserException, Exception) as e:
-        elapsed = time.time() - start_time
-        logger.warning(f"[rewrite_query] Failed in {elapsed:.2f}s: {e}")
+        with timed(logger, "rewrite_query", logging.INFO) as timer:
+            response = await cached_llm_call(
+                "rewrite_query",
+                user_query,
+                lambda: _bounded_llm_call(
+                    _LLM_REWRITE.ainvoke(
+                        [_SYS_AGENT, HumanMessage(_REWRITE_QUERY_PROMPT.format(user_query=user_query))],
+                        options=_llm_options(64),
+                        format="json",
+                    ),
+                ),
+                RewriteQuery,
+            )
+            rewritten = response.rewritten_query.strip()
+            timer.describe("%s", rewritten)
+    except _LLM_ERRORS as e:
+        logger.warning("[rewrite_query] Failed in %.2fs: %s", timer.elapsed, e)
         return user_query
+    return rewritten or user_query
+
+
+def _split_reflexion_footer(footer_text: str) -> ReflexionFooter:
+    start = footer_text.find("{")
+    end = footer_text.rfind("}")
+    if start == -1 or end < start:
+        raise OutputParserException(f"Reflexion footer has no JSON object: {footer_text!r}")
+    return ReflexionFooter.model_validate_json(footer_text[start : end + 1])
+
+
+async def _astream_reflexion(messages: List[Any], log_name: str) -> ReflexionAnswer:
+    """Stream the free-text answer, then parse the JSON footer after the marker."""
+    answer_parts = []
+    footer_parts = []
+    buffer = ""
+    in_footer = False
+    # Hold back a marker-sized tail so a marker split across chunks is still found,
+    # while each chunk only re-scans that tail instead of the whole answer.
+    holdback = len(REFLEXION_FOOTER_MARKER) - 1
+
+    # Same total deadline as _bounded_llm_call; a TimeoutError reaches the caller's fallback.
+    async with _LLM_SEMAPHORE, asyncio.timeout(settings.LLM_TIMEOUT):
+        async for chunk in llm.astream(messages, options=_ANSWER_OPTIONS):
+            text = chunk.content or ""
+            if in_footer:
+                footer_parts.append(text)
+                continue
+
+            buffer += text
+            marker_pos = buffer.find(REFLEXION_FOOTER_MARKER)
+            if marker_pos != -1:
+                answer_parts.append(buffer[:marker_pos])
+                footer_parts.append(buffer[marker_pos + len(REFLEXION_FOOTER_MARKER) :])
+                buffer = ""
+                in_footer = True
+            elif len(buffer) > holdback:
+                answer_parts.append(buffer[: len(buffer) - holdback])
+                buffer = buffer[len(buffer) - holdback :]
+
+    if buffer:
+        answer_parts.append(buffer)
+
+    answer = "".join(answer_parts).strip()
+    try:
+        footer = _split_reflexion_footer("".join(footer_parts))
+    except (OutputParserException, ValidationError) as e:
+        logger.warning("[%s] Failed to parse reflexion footer: %s", log_name, e)
+        footer = ReflexionFooter(
+            reflection={"missing": "unknown", "superfluous": "unknown"},
+            search_queries=[],
+            is_complete=True,
+        )
 
-
-def draft_reflexion_answer(user_query: str, retrieved_docs: str) -> ReflexionAnswer:
-    start_time = time.time()
-    logger.debug(
-        f"[draft_reflexion_answer] Input query: {user_query}, docs length: {len(retrieved_docs)} chars"
+    return ReflexionAnswer(
+        answer=answer,
+        reflection=footer.reflection,
+        search_queries=footer.search_queries,
+        is_complete=footer.is_complete,
     )
 
-    llm_structured = llm.with_structured_output(ReflexionAnswer)
-    system_prompt = """Ты финансовый аналитик.
+
+_DRAFT_REFLEXION_SYSTEM_PROMPT = f"""Ты финансовый аналитик.
 
 ЗАДАЧА:
 1) Дай подробный ответ (~200-300 слов) на вопрос.
@@ -364,53 +588,47 @@ def draft_reflexion_answer(user_query: str, retrieved_docs: str) -> ReflexionAns
 4) Проведи критическую рефлексию: что отсутствует и что лишнее.
 5) Если данных недостаточно, сгенерируй 1-3 уточняющих поисковых запроса.
 
-Верни JSON по схеме:
-{
-  "answer": "...",
-  "reflection": {"missing": "...", "superfluous": "..."},
+ФОРМАТ ОТВЕТА:
+Сначала напиши сам ответ обычным текстом в Markdown.
+Затем на отдельной строке выведи маркер {REFLEXION_FOOTER_MARKER} и после него JSON по схеме:
+{{
+  "reflection": {{"missing": "...", "superfluous": "..."}},
   "search_queries": ["..."],
   "is_complete": false
-}
+}}
 """
+_SYS_DRAFT = SystemMessage(_DRAFT_REFLEXION_SYSTEM_PROMPT)
+
+
+async def draft_reflexion_answer(user_query: str, retrieved_docs: str) -> ReflexionAnswer:
+    logger.debug(
+        "[draft_reflexion_answer] Input query: %s, docs length: %d chars",
+        user_query,
+        len(retrieved_docs),
+    )
+    retrieved_docs = fit_retrieved_docs(retrieved_docs, answer_budget_tokens())
+
     user_prompt = f"Вопрос: {user_query}\n\nДокументы:\n{retrieved_docs}"
-    messages = [SystemMessage(system_prompt), HumanMessage(user_prompt)]
+    messages = [_SYS_DRAFT, HumanMessage(user_prompt)]
 
     try:
-        response = llm_structured.invoke(
-            messages,
-            options={
-                "num_predict": settings.OLLAMA_NUM_PREDICT,
-                "temperature": 0.2,
-                "num_ctx": settings.OLLAMA_CONTEXT_LENGTH,
-            },
-            format="json",
-        )
-        elapsed = time.time() - start_time
-        logger.info(
-            f"[draft_reflexion_answer] complete={response.is_complete} in {elapsed:.2f}s queries={len(response.search_queries)}"
-        )
-        return response
-    except (OutputParserException, Exception) as e:
-        elapsed = time.time() - start_time
-        logger.warning(f"[draft_reflexion_answer] Failed in {elapsed:.2f}s: {e}")
+        with timed(logger, "draft_reflexion_answer", logging.INFO) as timer:
+            response = await _astream_reflexion(messages, "draft_reflexion_answer")
+            timer.describe(
+                "complete=%s queries=%d", response.is_complete, len(response.search_queries)
+            )
+    except _LLM_ERRORS as e:
+        logger.warning("[draft_reflexion_answer] Failed in %.2fs: %s", timer.elapsed, e)
         return ReflexionAnswer(
-            answer="Не удалось сформировать ответ. Попробуйте уточнить запрос.",
+            answer=EMPTY_ANSWER,
             reflection={"missing": "unknown", "superfluous": "unknown"},
             search_queries=[],
             is_complete=True,
         )
+    return response
 
 
-def revise_reflexion_answer(
-    user_query: str, retrieved_docs: str, prior_answer: str
-) -> ReflexionAnswer:
-    start_time = time.time()
-    logger.debug(
-        f"[revise_reflexion_answer] Input query: {user_query}, docs length: {len(retrieved_docs)} chars"
-    )
-
-    llm_structured = llm.with_structured_output(ReflexionAnswer)
-    system_prompt = """Ты финансовый аналитик.
+_REVISE_REFLEXION_SYSTEM_PROMPT = f"""Ты финансовый аналитик.
 
 ЗАДАЧА:
 1) Перепиши ответ, используя новые документы.
@@ -420,43 +638,53 @@ def revise_reflexion_answer(
 
 Если данных достаточно, верни is_complete=true и пустой список search_queries.
 
-ВАЖНО: Верни СТРОГО JSON c ключами:
-{
-  "answer": "...",
-  "reflection": {"missing": "...", "superfluous": "..."},
+ФОРМАТ ОТВЕТА:
+Сначала напиши переписанный ответ обычным текстом в Markdown.
+Затем на отдельной строке выведи маркер {REFLEXION_FOOTER_MARKER} и после него СТРОГО JSON c ключами:
+{{
+  "reflection": {{"missing": "...", "superfluous": "..."}},
   "search_queries": ["..."],
   "is_complete": false
-}
+}}
 Никаких других ключей (например, response/reflections/redundant) не используй.
 """
+_SYS_REVISE = SystemMessage(_REVISE_REFLEXION_SYSTEM_PROMPT)
+
+
+async def revise_reflexion_answer(
+    user_query: str, retrieved_docs: str, prior_answer: str
+) -> ReflexionAnswer:
+    logger.debug(
+        "[revise_reflexion_answer] Input query: %s, docs length: %d chars",
+        user_query,
+        len(retrieved_docs),
+    )
+    retrieved_docs = fit_retrieved_docs(
+        retrieved_docs, answer_budget_tokens() - estimate_tokens(prior_answer)
+    )
+
     user_prompt = (
         f"Вопрос: {user_query}\n\n"
         f"Предыдущий ответ:\n{prior_answer}\n\n"
         f"Новые документы:\n{retrieved_docs}"
     )
-    messages = [SystemMessage(system_prompt), HumanMessage(user_prompt)]
+    messages = [_SYS_REVISE, HumanMessage(user_prompt)]
 
     try:
-        response = llm_structured.invoke(
-            messages,
-            options={
-                "num_predict": settings.OLLAMA_NUM_PREDICT,
-                "temperature": 0.2,
-                "num_ctx": settings.OLLAMA_CONTEXT_LENGTH,
-            },
-            format="json",
-        )
-        elapsed = time.time() - start_time
-        logger.info(
-            f"[revise_reflexion_answer] complete={response.is_complete} in {elapsed:.2f}s queries={len(response.search_queries)}"
-        )
-        return response
-    except (OutputParserException, Exception) as e:
-        elapsed = time.time() - start_time
-        logger.warning(f"[revise_reflexion_answer] Failed in {elapsed:.2f}s: {e}")
+        with timed(logger, "revise_reflexion_answer", logging.INFO) as timer:
+            response = await _astream_reflexion(messages, "revise_reflexion_answer")
+            timer.describe(
+                "complete=%s queries=%d", response.is_complete, len(response.search_queries)
+            )
+    except _LLM_ERRORS as e:
+        logger.warning("[revise_reflexion_answer] Failed in %.2fs: %s", timer.elapsed, e)
         return ReflexionAnswer(
             answer=prior_answer,
             reflection={"missing": "unknown", "superfluous": "unknown"},
             search_queries=[],
             is_complete=True,
         )
+
+    if not response.answer:
+        response.answer = prior_answer
+    return response
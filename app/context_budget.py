@@ -0,0 +1,83 @@
+import re
+from typing import List, Tuple
+
+from app.config import settings
+
+
+CHARS_PER_TOKEN = 4
+
+# Blocks start at a page, a web-search result or a reflexion query header.
+_BLOCK_RE = re.compile(r"(?m)^(?=--- Document \d+ ---$|\[WEB_SEARCH\]$|--- Query: .* ---$)")
+_DOC_NUMBER_RE = re.compile(r"^--- Document (\d+) ---")
+_QUERY_HEADER_RE = re.compile(r"^--- Query: .* ---\s*$")
+_WEB_SEARCH_MARKER = "[WEB_SEARCH]"
+
+# Headers are a line each and label the pages after them, so they always stay.
+# Web results only exist when retrieval was graded irrelevant; they go just ahead
+# of the first page of any sub-query. Unrecognized text goes last.
+_HEADER_SCORE = float("inf")
+_WEB_SEARCH_SCORE = -0.5
+_OTHER_SCORE = float("-inf")
+
+
+def estimate_tokens(text: str) -> int:
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def answer_budget_tokens() -> int:
+    return (
+        settings.OLLAMA_CONTEXT_LENGTH
+        - settings.OLLAMA_NUM_PREDICT
+        - settings.CONTEXT_RESERVED_TOKENS
+    )
+
+
+def fit_docs(docs: List[Tuple[float, str]], budget_tokens: int) -> str:
+    """Keep the highest-scored docs that fit the budget, in their original order."""
+    ranked = sorted(range(len(docs)), key=lambda i: docs[i][0], reverse=True)
+    kept = {}
+    used = 0
+    for i in ranked:
+        text = docs[i][1]
+        cost = estimate_tokens(text)
+        if used + cost > budget_tokens:
+            if not kept:
+                kept[i] = text[: budget_tokens * CHARS_PER_TOKEN]
+            break
+        kept[i] = text
+        used += cost
+    return "\n\n".join(kept[i].strip() for i in sorted(kept))
+
+
+def split_docs(retrieved_docs: str) -> List[Tuple[float, str]]:
+    # Pages come out of the reranker best-first, so "Document N" scores -N; this keeps
+    # the top pages of every sub-query before the tail of any of them.
+    docs = []
+    for block in _BLOCK_RE.split(retrieved_docs):
+        if not block.strip():
+            continue
+        match = _DOC_NUMBER_RE.match(block)
+        if match:
+            score = -float(match.group(1))
+        elif block.startswith(_WEB_SEARCH_MARKER):
+            score = _WEB_SEARCH_SCORE
+        elif _QUERY_HEADER_RE.match(block):
+            score = _HEADER_SCORE
+        else:
+            score = _OTHER_SCORE
+        docs.append((score, block))
+    return docs
+
+
+def cap_doc(text: str, max_tokens: int) -> str:
+    max_chars = max_tokens * CHARS_PER_TOKEN
+    return text if len(text) <= max_chars else text[:max_chars]
+
+
+def fit_retrieved_docs(retrieved_docs: str, budget_tokens: int) -> str:
+    # A single oversized page (e.g. a full financial table) must not crowd out the rest.
+    per_doc = min(settings.DOC_CONTEXT_TOKENS, budget_tokens)
+    if estimate_tokens(retrieved_docs) <= per_doc:
+        return retrieved_docs
+    docs = [(score, cap_doc(text, per_doc)) for score, text in split_docs(retrieved_docs)]
+    return fit_docs(docs, budget_tokens)
@@ -1,12 +1,45 @@
+from pgvector import HalfVector, Vector
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.orm import declarative_base, sessionmaker
-from sqlalchemy import text
+from sqlalchemy import event, text
 
 from app.config import settings
 
 
 engine = create_async_engine(settings.DATABASE_URL, future=True, echo=False)
 
+
+def _binary_encoder(vector_cls):
+    # SQLAlchemy's pgvector bind processors already render text; accept both forms.
+    def encode(value):
+        if isinstance(value, str):
+            value = vector_cls.from_text(value)
+        return vector_cls._to_db_binary(value)
+
+    return encode
+
+
+async def _register_vector_codecs(conn) -> None:
+    for type_name, vector_cls in (("vector", Vector), ("halfvec", HalfVector)):
+        await conn.set_type_codec(
+            type_name,
+            schema="public",
+            encoder=_binary_encoder(vector_cls),
+            decoder=vector_cls._from_db_binary,
+            format="binary",
+        )
+
+
+@event.listens_for(engine.sync_engine, "connect")
+def _on_connect(dbapi_connection, connection_record) -> None:
+    # Binary wire format: vectors arrive as numpy buffers instead of text that is
+    # parsed float by float in Python.
+    try:
+        dbapi_connection.run_async(_register_vector_codecs)
+    except ValueError:
+        # Extension not created yet (first start); pgvector falls back to the text format.
+        pass
+
 AsyncSessionLocal = sessionmaker(
     bind=engine,
     class_=AsyncSession,
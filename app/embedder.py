@@ -0,0 +1,56 @@
+import threading
+import time
+from typing import List, Optional
+
+import numpy as np
+
+from app.config import settings
+from app.logger import setup_logger
+
+
+logger = setup_logger(__name__)
+
+
+class Embedder:
+    """In-process sentence-transformers encoder, loaded once per process."""
+
+    _instance: Optional["Embedder"] = None
+    _lock = threading.Lock()
+
+    def __init__(self, model_name: str, device: str, batch_size: int):
+        import torch
+        from sentence_transformers import SentenceTransformer
+
+        if device.startswith("cuda") and not torch.cuda.is_available():
+            logger.warning("[Embedder] CUDA is not available, falling back to CPU")
+            device = "cpu"
+
+        start_time = time.time()
+        self.model = SentenceTransformer(model_name, device=device, trust_remote_code=True)
+        self.batch_size = batch_size
+        elapsed = time.time() - start_time
+        logger.info("[Embedder] Loaded %s on %s in %.2fs", model_name, device, elapsed)
+
+    @classmethod
+    def get(cls) -> "Embedder":
+        if cls._instance is None:
+            with cls._lock:
+                if cls._instance is None:
+                    cls._instance = cls(
+                        settings.EMBED_LOCAL_MODEL,
+                        settings.EMBED_DEVICE,
+                        settings.EMBED_BATCH_SIZE,
+                    )
+        return cls._instance
+
+    def embed_batch(self, texts: List[str]) -> np.ndarray:
+        start_time = time.time()
+        embeddings = self.model.encode(
+            texts,
+            batch_size=self.batch_size,
+            convert_to_numpy=True,
+            normalize_embeddings=True,
+        )
+        elapsed = time.time() - start_time
+        logger.info("[Embedder] Generated %d embeddings in %.2fs", len(texts), elapsed)
+        return embeddings
@@ -1,37 +1,42 @@
-from typing import List, TypedDict, Optional, Dict, Any
+import asyncio
+import logging
+from typing import List, TypedDict, Optional, Dict, Any, Tuple
 
 from langgraph.graph import StateGraph, START, END
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from app.agent import (
-    decompose_query,
-    extract_filters,
-    generate_ranking_keywords,
-    grade_documents,
-    rewrite_query,
-    generate_answer,
+    EMPTY_ANSWER,
+    aanalyze_query,
+    aplan_subqueries,
+    agrade_documents,
+    arewrite_query,
+    agenerate_answer,
     draft_reflexion_answer,
     revise_reflexion_answer,
 )
-from app.retrieval import search_docs, write_debug_log
+from app.db import AsyncSessionLocal
+from app.ollama_embed import embed_queries, embed_query
+from app.retrieval import format_docs, search_docs, search_docs_batch, write_debug_log
 from app.web_search import web_search
+from app.llm_schemas import QueryAnalysis, QueryScope, SubQueryPlan
 from app.logger import setup_logger
 from app.config import settings
 
 
 logger = setup_logger(__name__)
 
+OUT_OF_SCOPE_ANSWER = "Запрос не относится к финансовым данным из SEC-отчётности. "
+
 
 class QueryState(TypedDict, total=False):
     query: str
     session: Any
     k: int
+    query_analysis: QueryAnalysis
     sub_queries: List[str]
-    sub_index: int
-    current_query: str
-    rewrite_attempted: bool
+    sub_query_plans: List[SubQueryPlan]
     retrieved_docs_text: str
-    is_relevant: bool
-    web_text: str
     combined_context: List[str]
     final_answer: str
     iteration_count: int
@@ -40,34 +45,40 @@ class QueryState(TypedDict, total=False):
     reflexion_answer: str
 
 
-def _format_docs(docs) -> str:
-    doc_text = []
-    for i, doc in enumerate(docs, 1):
-        doc_text.append(f"--- Document {i} ---")
-        doc_text.append(f"company_name: {doc.company_name}")
-        doc_text.append(f"doc_type: {doc.doc_type}")
-        doc_text.append(f"fiscal_year: {doc.fiscal_year}")
-        doc_text.append(f"fiscal_quarter: {doc.fiscal_quarter}")
-        doc_text.append(f"page: {doc.page}")
-        doc_text.append(f"source_file: {doc.source_file}")
-        doc_text.append(f"file_hash: {doc.file_hash}")
-        doc_text.append("")
-        doc_text.append("Content:")
-        doc_text.append(doc.content)
-        doc_text.append("")
-    return "\n".join(doc_text)
+async def _analysis_for(state: QueryState, query: str) -> QueryAnalysis:
+    analysis = state.get("query_analysis")
+    if analysis is not None and query == state["query"]:
+        return analysis
+    for plan in state.get("sub_query_plans", []):
+        if plan.query == query:
+            return QueryAnalysis(
+                scope=QueryScope(in_scope=True),
+                filters=plan.filters,
+                subqueries=[query],
+                keywords=plan.keywords,
+            )
+    return await aanalyze_query(query)
+
+
+async def scope_node(state: QueryState) -> QueryState:
+    analysis = await _analysis_for(state, state["query"])
+    if not analysis.scope.in_scope:
+        logger.info("[graph.scope] Out-of-scope query blocked: %s", analysis.scope.reason)
+    return {"query_analysis": analysis}
+
+
+async def refuse_node(state: QueryState) -> QueryState:
+    return {"final_answer": OUT_OF_SCOPE_ANSWER}
 
 
 async def decompose_node(state: QueryState) -> QueryState:
     user_query = state["query"]
-    queries = decompose_query(user_query)
-    logger.info(f"[graph.decompose] Sub-queries: {queries}")
-    current = queries[0] if queries else user_query
+    analysis = await _analysis_for(state, user_query)
+    queries = analysis.subqueries
+    logger.info("[graph.decompose] Sub-queries: %s", queries)
     return {
+        "query_analysis": analysis,
         "sub_queries": queries,
-        "sub_index": 0,
-        "current_query": current,
-        "rewrite_attempted": False,
         "combined_context": [],
         "iteration_count": 0,
         "reflexion_queries": [],
@@ -76,93 +87,106 @@ async def decompose_node(state: QueryState) -> QueryState:
     }
 
 
-async def retrieve_node(state: QueryState) -> QueryState:
-    query = state["current_query"]
-    logger.info(f"[graph.retrieve] Query: {query}")
-
-    filters = extract_filters(query)
-    keywords = generate_ranking_keywords(query)
-    docs = await search_docs(
-        state["session"],
+async def plan_node(state: QueryState) -> QueryState:
+    sub_queries = state.get("sub_queries", [])
+    pending = [query for query in sub_queries if query != state["query"]]
+    if not pending:
+        return {"sub_query_plans": []}
+    plans = await aplan_subqueries(pending)
+    return {"sub_query_plans": plans}
+
+
+async def _retrieve(
+    session: AsyncSession,
+    state: QueryState,
+    query: str,
+    query_vec: Optional[List[float]] = None,
+) -> Tuple[QueryAnalysis, str, List[Tuple[str, float]]]:
+    logger.info("[graph.retrieve] Query: %s", query)
+
+    if query_vec is None:
+        # A rewritten query may need a fresh analysis; embed it in the meantime.
+        analysis, query_vec = await asyncio.gather(
+            _analysis_for(state, query), embed_query(query)
+        )
+    else:
+        analysis = await _analysis_for(state, query)
+    results = await search_docs(
+        session,
         query,
-        filters=filters,
-        ranking_keywords=keywords,
+        filters=analysis.filters.model_dump(exclude_none=True),
+        ranking_keywords=analysis.keywords,
         k=state["k"],
         fetch_k=settings.DEFAULT_FETCH_K,
+        query_vec=query_vec,
     )
-    write_debug_log(docs)
-    chunk_text = _format_docs(docs)
-    logger.debug(f"[graph.retrieve] Retrieved docs length: {len(chunk_text)}")
-    return {"retrieved_docs_text": chunk_text}
+    docs = [doc for doc, _ in results]
+    chunk_text = format_docs(docs)
+    if logger.isEnabledFor(logging.DEBUG):
+        await write_debug_log(query, chunk_text)
+    logger.debug("[graph.retrieve] Retrieved docs length: %d", len(chunk_text))
+    return analysis, chunk_text, [(doc.content, distance) for doc, distance in results]
 
 
-async def grade_node(state: QueryState) -> QueryState:
-    retrieved_docs = state.get("retrieved_docs_text", "")
-    if not retrieved_docs:
+async def _grade(query: str, retrieved: List[Tuple[str, float]]) -> bool:
+    if not retrieved:
         logger.info("[graph.grade] No documents to grade")
-        return {"is_relevant": False}
+        return False
+    decision = await agrade_documents(query, retrieved)
+    return decision.is_relevant
+
+
+async def _process_subquery(state: QueryState, query: str, query_vec: List[float]) -> str:
+    """Retrieve -> grade -> (rewrite -> retrieve -> grade -> web search) for one sub-query."""
+    web_text = ""
+    # Sub-queries run concurrently, and an AsyncSession must not be shared between tasks.
+    async with AsyncSessionLocal() as session:
+        analysis, chunk_text, retrieved = await _retrieve(session, state, query, query_vec)
+        if not await _grade(query, retrieved):
+            filters = analysis.filters.model_dump(exclude_none=True)
+            rewritten = await arewrite_query(query, filters)
+            if rewritten == query:
+                # Same query would retrieve and grade the same documents again.
+                logger.info("[graph.rewrite] Query unchanged, falling back to web search")
+                web_text = await web_search(query)
+            else:
+                query = rewritten
+                logger.info("[graph.rewrite] Rewritten query: %s", query)
+                analysis, chunk_text, retrieved = await _retrieve(session, state, query)
+                if not await _grade(query, retrieved):
+                    web_text = await web_search(query)
 
-    decision = grade_documents(state["current_query"], retrieved_docs)
-    return {"is_relevant": decision.is_relevant}
-
-
-async def rewrite_node(state: QueryState) -> QueryState:
-    rewritten = rewrite_query(state["current_query"])
-    logger.info(f"[graph.rewrite] Rewritten query: {rewritten}")
-    return {
-        "current_query": rewritten,
-        "rewrite_attempted": True,
-    }
-
-
-async def web_search_node(state: QueryState) -> QueryState:
-    query = state["current_query"]
-    result = web_search(query)
-    return {"web_text": result}
-
-
-async def append_context_node(state: QueryState) -> QueryState:
-    combined = state.get("combined_context", [])
-    chunk_text = state.get("retrieved_docs_text", "")
-    web_text = state.get("web_text", "")
     if web_text:
         if chunk_text:
-            chunk_text = f"{chunk_text}\n\n[WEB_SEARCH]\n{web_text}"
-        else:
-            chunk_text = f"[WEB_SEARCH]\n{web_text}"
+            return f"{chunk_text}\n\n[WEB_SEARCH]\n{web_text}"
+        return f"[WEB_SEARCH]\n{web_text}"
+    return chunk_text
 
-    if chunk_text:
-        combined.append(chunk_text)
 
-    sub_queries = state.get("sub_queries", [])
-    sub_index = state.get("sub_index", 0) + 1
-
-    next_query = None
-    if sub_index < len(sub_queries):
-        next_query = sub_queries[sub_index]
-
-    return {
-        "combined_context": combined,
-        "sub_index": sub_index,
-        "current_query": next_query,
-        "rewrite_attempted": False,
-        "retrieved_docs_text": "",
-        "web_text": "",
-        "is_relevant": True,
-    }
+async def subqueries_node(state: QueryState) -> QueryState:
+    queries = state.get("sub_queries") or [state["query"]]
+    # One embed request for every sub-query instead of one per branch.
+    query_vecs = await embed_queries(queries)
+    contexts = await asyncio.gather(
+        *(_process_subquery(state, query, vec) for query, vec in zip(queries, query_vecs))
+    )
+    return {"combined_context": [context for context in contexts if context]}
 
 
 async def answer_node(state: QueryState) -> QueryState:
     combined_retrieved = "\n\n".join(state.get("combined_context", []))
-    answer = generate_answer(state["query"], combined_retrieved)
+    parts = [token async for token in agenerate_answer(state["query"], combined_retrieved)]
+    answer = "".join(parts).strip() or EMPTY_ANSWER
     return {"final_answer": answer}
 
 
 async def reflexion_draft_node(state: QueryState) -> QueryState:
     combined_retrieved = "\n\n".join(state.get("combined_context", []))
-    response = draft_reflexion_answer(state["query"], combined_retrieved)
+    response = await draft_reflexion_answer(state["query"], combined_retrieved)
     logger.info(
-        f"[graph.reflexion.draft] complete={response.is_complete} queries={len(response.search_queries)}"
+        "[graph.reflexion.draft] complete=%s queries=%d",
+        response.is_complete,
+        len(response.search_queries),
     )
     return {
         "reflexion_answer": response.answer,
@@ -177,20 +201,27 @@ async def reflexion_retrieve_node(state: QueryState) -> QueryState:
     if not search_queries:
         return {"retrieved_docs_text": ""}
 
+    # One planning call for every follow-up query; per-query analysis only if it fails.
+    plans = await aplan_subqueries(search_queries)
+    if not plans:
+        plans = await asyncio.gather(*(aanalyze_query(query) for query in search_queries))
+    searches = [
+        (query, plan.filters.model_dump(exclude_none=True), plan.keywords)
+        for query, plan in zip(search_queries, plans)
+    ]
+    batch_results = await search_docs_batch(
+        state["session"],
+        searches,
+        k=state["k"],
+        fetch_k=settings.DEFAULT_FETCH_K,
+    )
+
     all_retrieved = []
-    for query in search_queries:
-        filters = extract_filters(query)
-        keywords = generate_ranking_keywords(query)
-        docs = await search_docs(
-            state["session"],
-            query,
-            filters=filters,
-            ranking_keywords=keywords,
-            k=state["k"],
-            fetch_k=settings.DEFAULT_FETCH_K,
-        )
-        write_debug_log(docs)
-        chunk_text = _format_docs(docs)
+    for query, results in zip(search_queries, batch_results):
+        docs = [doc for doc, _ in results]
+        chunk_text = format_docs(docs)
+        if logger.isEnabledFor(logging.DEBUG):
+            await write_debug_log(query, chunk_text)
         if chunk_text:
             all_retrieved.append(f"--- Query: {query} ---\n{chunk_text}")
 
@@ -198,14 +229,17 @@ async def reflexion_retrieve_node(state: QueryState) -> QueryState:
 
 
 async def reflexion_revise_node(state: QueryState) -> QueryState:
-    response = revise_reflexion_answer(
+    response = await revise_reflexion_answer(
         state["query"],
         state.get("retrieved_docs_text", ""),
         state.get("reflexion_answer", ""),
     )
     iteration = state.get("iteration_count", 1) + 1
     logger.info(
-        f"[graph.reflexion.revise] complete={response.is_complete} queries={len(response.search_queries)} iteration={iteration}"
+        "[graph.reflexion.revise] complete=%s queries=%d iteration=%d",
+        response.is_complete,
+        len(response.search_queries),
+        iteration,
     )
     return {
         "reflexion_answer": response.answer,
@@ -215,17 +249,8 @@ async def reflexion_revise_node(state: QueryState) -> QueryState:
     }
 
 
-def _route_after_grade(state: QueryState) -> str:
-    if state.get("is_relevant", False):
-        return "append_context"
-    if state.get("rewrite_attempted", False):
-        return "web_search"
-    return "rewrite"
-
-
-def _route_after_append(state: QueryState) -> str:
-    current_query = state.get("current_query")
-    return "reflexion_draft" if not current_query else "retrieve"
+def _route_after_scope(state: QueryState) -> str:
+    return "decompose" if state["query_analysis"].scope.in_scope else "refuse"
 
 
 def _route_after_reflexion_draft(state: QueryState) -> str:
@@ -250,28 +275,22 @@ def _route_after_reflexion_revise(state: QueryState) -> str:
 
 def build_graph():
     builder = StateGraph(QueryState)
+    builder.add_node("scope", scope_node)
+    builder.add_node("refuse", refuse_node)
     builder.add_node("decompose", decompose_node)
-    builder.add_node("retrieve", retrieve_node)
-    builder.add_node("grade", grade_node)
-    builder.add_node("rewrite", rewrite_node)
-    builder.add_node("web_search", web_search_node)
-    builder.add_node("append_context", append_context_node)
+    builder.add_node("plan", plan_node)
+    builder.add_node("subqueries", subqueries_node)
     builder.add_node("answer", answer_node)
     builder.add_node("reflexion_draft", reflexion_draft_node)
     builder.add_node("reflexion_retrieve", reflexion_retrieve_node)
     builder.add_node("reflexion_revise", reflexion_revise_node)
 
-    builder.add_edge(START, "decompose")
-    builder.add_edge("decompose", "retrieve")
-    builder.add_edge("retrieve", "grade")
-    builder.add_conditional_edges(
-        "grade", _route_after_grade, ["append_context", "rewrite", "web_search"]
-    )
-    builder.add_edge("rewrite", "retrieve")
-    builder.add_edge("web_search", "append_context")
-    builder.add_conditional_edges(
-        "append_context", _route_after_append, ["retrieve", "reflexion_draft"]
-    )
+    builder.add_edge(START, "scope")
+    builder.add_conditional_edges("scope", _route_after_scope, ["decompose", "refuse"])
+    builder.add_edge("refuse", END)
+    builder.add_edge("decompose", "plan")
+    builder.add_edge("plan", "subqueries")
+    builder.add_edge("subqueries", "reflexion_draft")
     builder.add_conditional_edges(
         "reflexion_draft",
         _route_after_reflexion_draft,
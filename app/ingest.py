@@ -1,36 +1,64 @@
+import asyncio
+import csv
 import hashlib
+import io
+import logging
+import math
 import os
+import threading
 import time
+import uuid
+from functools import lru_cache
+import numpy as np
+import orjson
 from pathlib import Path
-from typing import List, Tuple
+from typing import Iterator, List, Optional, Tuple
 
+from docling.datamodel.base_models import InputFormat
 from docling.document_converter import DocumentConverter
 from pypdf import PdfReader
-from sqlalchemy import select
+from sqlalchemy import insert, select, text
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from app.config import settings
 from app.models import DocumentPage
 from app.ollama_embed import embed_texts
-from app.logger import setup_logger
+from app.retrieval import page_term_freqs
+from app.logger import setup_logger, timed
 
 
 logger = setup_logger(__name__)
 
+_COPY_COLUMNS = [
+    "id",
+    "file_hash",
+    "source_file",
+    "page",
+    "company_name",
+    "doc_type",
+    "fiscal_year",
+    "fiscal_quarter",
+    "content",
+    "embedding",
+    "term_freqs",
+]
+
 
 def compute_file_hash(file_path: str) -> str:
-    sha256_hash = hashlib.sha256()
     with open(file_path, "rb") as f:
-        for byte_block in iter(lambda: f.read(4096), b""):
+        if hasattr(hashlib, "file_digest"):
+            return hashlib.file_digest(f, "sha256").hexdigest()
+        sha256_hash = hashlib.sha256()
+        for byte_block in iter(lambda: f.read(1 << 20), b""):
             sha256_hash.update(byte_block)
-    return sha256_hash.hexdigest()
+        return sha256_hash.hexdigest()
 
 
-def extract_metadata_from_filename(filename: str) -> dict:
+@lru_cache(maxsize=1024)
+def _parse_filename(filename: str) -> Tuple[Optional[str], Optional[str], Optional[int], Optional[str]]:
     name = filename.replace(".pdf", "")
     parts = name.split()
 
-    metadata = {}
     quarter = None
     year = None
     if len(parts) >= 4 and parts[2].lower().startswith("q"):
@@ -42,95 +70,241 @@ def extract_metadata_from_filename(filename: str) -> dict:
     elif len(parts) >= 4 and parts[3].isdigit():
         year = int(parts[3])
 
-    metadata["fiscal_quarter"] = quarter
-    metadata["fiscal_year"] = year
+    company_name = parts[0] if len(parts) > 0 else None
+    doc_type = parts[1] if len(parts) > 1 else None
+    return company_name, doc_type, year, quarter
+
+
+def extract_metadata_from_filename(filename: str) -> dict:
+    company_name, doc_type, year, quarter = _parse_filename(filename)
+    return {
+        "fiscal_quarter": quarter,
+        "fiscal_year": year,
+        "company_name": company_name,
+        "doc_type": doc_type,
+    }
+
+
+_CONVERTER: Optional[DocumentConverter] = None
+_CONVERTER_LOCK = threading.Lock()
+
 
-    metadata["company_name"] = parts[0] if len(parts) > 0 else None
-    metadata["doc_type"] = parts[1] if len(parts) > 1 else None
+def _get_converter() -> DocumentConverter:
+    # Docling loads its layout/OCR models per converter, so one is shared process-wide.
+    global _CONVERTER
+    if _CONVERTER is None:
+        with _CONVERTER_LOCK:
+            if _CONVERTER is None:
+                _CONVERTER = DocumentConverter()
+    return _CONVERTER
 
-    return metadata
 
+def warm_up_converter() -> None:
+    start_time = time.time()
+    try:
+        _get_converter().initialize_pipeline(InputFormat.PDF)
+    except Exception as e:
+        logger.warning("[warm_up_converter] Docling warm-up failed, will load on first ingest: %s", e)
+        return
+    elapsed = time.time() - start_time
+    logger.info("[warm_up_converter] Docling PDF pipeline ready in %.2fs", elapsed)
 
-def _extract_pdf_pages_docling(pdf_path: str) -> List[str]:
-    converter = DocumentConverter()
-    result = converter.convert(pdf_path)
 
+def _split_markdown_pages(result) -> List[str]:
     page_break = "<!-- page break -->"
     markdown_text = result.document.export_to_markdown(
         page_break_placeholder=page_break
     )
-    pages = markdown_text.split(page_break)
-    return pages
+    return markdown_text.split(page_break)
 
 
-def _extract_pdf_pages_pypdf(pdf_path: str) -> List[str]:
+# Every docling convert() reopens and re-scans the whole PDF even with page_range,
+# so the batch count is capped and large files get proportionally larger batches.
+_MAX_PAGE_BATCHES = 8
+
+
+def iter_pdf_page_batches(pdf_path: str, batch_size: int) -> Iterator[Tuple[int, List[str]]]:
+    """Yield (first_page, pages) batches so later stages can start before the PDF is done."""
     reader = PdfReader(pdf_path)
-    pages = []
-    for page in reader.pages:
-        text = page.extract_text() or ""
-        pages.append(text)
-    return pages
+    total_pages = len(reader.pages)
+    batch_size = max(batch_size, math.ceil(total_pages / _MAX_PAGE_BATCHES))
+    use_docling = True
+    for start in range(1, total_pages + 1, batch_size):
+        end = min(start + batch_size - 1, total_pages)
+        pages = None
+        if use_docling:
+            try:
+                pages = _split_markdown_pages(
+                    _get_converter().convert(pdf_path, page_range=(start, end))
+                )
+            except Exception:
+                # Fallback for offline environments without model downloads.
+                use_docling = False
+        if pages is None:
+            pages = [reader.pages[i].extract_text() or "" for i in range(start - 1, end)]
+        yield start, pages
 
 
-def extract_pdf_pages(pdf_path: str) -> List[str]:
-    try:
-        return _extract_pdf_pages_docling(pdf_path)
-    except Exception:
-        # Fallback for offline environments without model downloads.
-        return _extract_pdf_pages_pypdf(pdf_path)
+def _vector_literal(embedding: np.ndarray) -> str:
+    return "[" + ",".join(map(str, embedding.tolist())) + "]"
+
+
+def _json_literal(value: dict) -> str:
+    return orjson.dumps(value).decode("utf-8")
+
+
+_COPY_ENCODERS = {"embedding": _vector_literal, "term_freqs": _json_literal}
+
+
+def _copy_value(column: str, value):
+    encoder = _COPY_ENCODERS.get(column)
+    return encoder(value) if encoder else value
+
+
+async def _copy_pages(
+    session: AsyncSession,
+    file_hash: str,
+    source_file: str,
+    file_metadata: dict,
+    pages: List[str],
+    page_embeddings: np.ndarray,
+    first_page: int = 1,
+) -> None:
+    company_name = file_metadata.get("company_name")
+    doc_type = file_metadata.get("doc_type")
+    fiscal_year = file_metadata.get("fiscal_year")
+    fiscal_quarter = file_metadata.get("fiscal_quarter")
+    rows = [
+        {
+            "id": uuid.uuid4(),
+            "file_hash": file_hash,
+            "source_file": source_file,
+            "page": first_page + offset,
+            "company_name": company_name,
+            "doc_type": doc_type,
+            "fiscal_year": fiscal_year,
+            "fiscal_quarter": fiscal_quarter,
+            "content": page_text,
+            "embedding": page_embeddings[offset],
+            "term_freqs": page_term_freqs(page_text),
+        }
+        for offset, page_text in enumerate(pages)
+    ]
+
+    # COPY runs on the session's own connection, inside its transaction.
+    conn = await session.connection()
+    raw = await conn.get_raw_connection()
+    copy_to_table = getattr(raw.driver_connection, "copy_to_table", None)
+    if copy_to_table is None:
+        # Drivers without asyncpg's COPY API get one executemany INSERT instead.
+        await session.execute(insert(DocumentPage), rows)
+        return
+
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    for row in rows:
+        writer.writerow([_copy_value(column, row[column]) for column in _COPY_COLUMNS])
+    await copy_to_table(
+        DocumentPage.__tablename__,
+        source=io.BytesIO(buf.getvalue().encode("utf-8")),
+        columns=_COPY_COLUMNS,
+        format="csv",
+        force_not_null=["content"],
+    )
+
+
+async def bulk_load_begin(session: AsyncSession) -> None:
+    logger.info("[bulk_load] Dropping document_pages indexes for bulk load")
+    await session.execute(text("SELECT document_pages_bulk_load_begin()"))
+    await session.commit()
+
+
+async def bulk_load_end(session: AsyncSession) -> None:
+    with timed(logger, "bulk_load_end", logging.INFO):
+        # Indexes must come back even if the batch failed midway.
+        await session.rollback()
+        # Only for the rebuild: a parallel HNSW build sizes its shared memory segment
+        # from maintenance_work_mem, and it must fit in the container's /dev/shm.
+        await session.execute(
+            text("SELECT set_config('maintenance_work_mem', :value, true)"),
+            {"value": settings.INGEST_MAINTENANCE_WORK_MEM},
+        )
+        await session.execute(text("SELECT document_pages_bulk_load_end()"))
+        await session.commit()
 
 
 async def ingest_pdf_file(
     session: AsyncSession, pdf_path: str
 ) -> Tuple[bool, str]:
     start_time = time.time()
-    logger.info(f"[ingest_pdf_file] Starting ingestion for: {pdf_path}")
-    
-    file_hash = compute_file_hash(pdf_path)
-    logger.debug(f"[ingest_pdf_file] Computed file hash: {file_hash}")
+    logger.info("[ingest_pdf_file] Starting ingestion for: %s", pdf_path)
     
+    hash_task = asyncio.create_task(asyncio.to_thread(compute_file_hash, pdf_path))
+    source_file = Path(pdf_path).name
+    file_metadata = extract_metadata_from_filename(source_file)
+    logger.info("[ingest_pdf_file] Extracted metadata: %s", file_metadata)
+    file_hash = await hash_task
+    logger.debug("[ingest_pdf_file] Computed file hash: %s", file_hash)
+
     existing = await session.execute(
-        select(DocumentPage.id).where(DocumentPage.file_hash == file_hash)
+        select(DocumentPage.id).where(DocumentPage.file_hash == file_hash).limit(1)
     )
     if existing.scalar_one_or_none():
-        logger.info(f"[ingest_pdf_file] File already exists in DB: {file_hash}")
+        logger.info("[ingest_pdf_file] File already exists in DB: %s", file_hash)
         return False, file_hash
 
-    file_metadata = extract_metadata_from_filename(Path(pdf_path).name)
-    logger.info(f"[ingest_pdf_file] Extracted metadata: {file_metadata}")
-
-    extract_start = time.time()
-    pages = extract_pdf_pages(pdf_path)
-    extract_elapsed = time.time() - extract_start
-    logger.info(f"[ingest_pdf_file] Extracted {len(pages)} pages in {extract_elapsed:.2f}s")
-
-    embed_start = time.time()
-    page_embeddings = embed_texts(pages)
-    embed_elapsed = time.time() - embed_start
-    logger.info(f"[ingest_pdf_file] Generated embeddings for {len(pages)} pages in {embed_elapsed:.2f}s")
-
-    for page_num, page_text in enumerate(pages, start=1):
-        metadata = dict(file_metadata)
-        doc = DocumentPage(
-            file_hash=file_hash,
-            source_file=Path(pdf_path).name,
-            page=page_num,
-            company_name=metadata.get("company_name"),
-            doc_type=metadata.get("doc_type"),
-            fiscal_year=metadata.get("fiscal_year"),
-            fiscal_quarter=metadata.get("fiscal_quarter"),
-            content=page_text,
-            embedding=page_embeddings[page_num - 1],
-        )
-        session.add(doc)
+    # Extract -> embed -> COPY as a pipeline over page batches, so embedding and
+    # COPY of one batch overlap with extraction of the next.
+    page_batches: asyncio.Queue = asyncio.Queue(maxsize=2)
+    embedded_batches: asyncio.Queue = asyncio.Queue(maxsize=2)
+
+    batches = iter_pdf_page_batches(pdf_path, settings.INGEST_PAGE_BATCH_SIZE)
+
+    async def extract_worker() -> None:
+        while (batch := await asyncio.to_thread(next, batches, None)) is not None:
+            await page_batches.put(batch)
+        await page_batches.put(None)
+
+    async def embed_worker() -> None:
+        while (batch := await page_batches.get()) is not None:
+            first_page, pages = batch
+            embeddings = await embed_texts(pages)
+            await embedded_batches.put(
+                (first_page, pages, np.asarray(embeddings, dtype=np.float16))
+            )
+        await embedded_batches.put(None)
+
+    async def copy_worker() -> int:
+        copied = 0
+        while (batch := await embedded_batches.get()) is not None:
+            first_page, pages, page_embeddings = batch
+            await _copy_pages(
+                session, file_hash, source_file, file_metadata, pages, page_embeddings, first_page
+            )
+            copied += len(pages)
+            logger.debug("[ingest_pdf_file] Copied pages %d-%d", first_page, first_page + len(pages) - 1)
+        return copied
+
+    pipeline_start = time.time()
+    async with asyncio.TaskGroup() as tg:
+        tg.create_task(extract_worker())
+        tg.create_task(embed_worker())
+        copy_task = tg.create_task(copy_worker())
+    page_count = copy_task.result()
+    pipeline_elapsed = time.time() - pipeline_start
+    logger.info(
+        "[ingest_pdf_file] Extracted, embedded and copied %d pages in %.2fs",
+        page_count,
+        pipeline_elapsed,
+    )
 
     commit_start = time.time()
     await session.commit()
     commit_elapsed = time.time() - commit_start
-    logger.debug(f"[ingest_pdf_file] DB commit took {commit_elapsed:.2f}s")
+    logger.debug("[ingest_pdf_file] DB commit took %.2fs", commit_elapsed)
     
     total_elapsed = time.time() - start_time
-    logger.info(f"[ingest_pdf_file] Successfully ingested {len(pages)} pages in {total_elapsed:.2f}s")
+    logger.info("[ingest_pdf_file] Successfully ingested %d pages in %.2fs", page_count, total_elapsed)
     
     return True, file_hash
 
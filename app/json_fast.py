@@ -0,0 +1,47 @@
+import re
+from typing import Annotated, Generic, Type, TypeVar
+
+import orjson
+from langchain_core.exceptions import OutputParserException
+from langchain_core.language_models import BaseChatModel
+from langchain_core.output_parsers import BaseOutputParser
+from langchain_core.runnables import Runnable
+from pydantic import BaseModel, SkipValidation, ValidationError
+
+
+T = TypeVar("T", bound=BaseModel)
+
+_CODE_FENCE_RE = re.compile(r"^```(?:json)?\s*|\s*```$")
+
+
+class FastPydanticParser(BaseOutputParser[T], Generic[T]):
+    """Validate a JSON LLM response straight into a Pydantic model."""
+
+    pydantic_object: Annotated[Type[T], SkipValidation()]
+
+    def parse(self, text: str) -> T:
+        cleaned = _CODE_FENCE_RE.sub("", text.strip())
+        try:
+            # pydantic-core parses and validates in one pass, without a Python dict.
+            return self.pydantic_object.model_validate_json(cleaned)
+        except ValidationError:
+            pass
+
+        # Slow path: the model wrapped the object in extra text.
+        start, end = cleaned.find("{"), cleaned.rfind("}")
+        try:
+            obj = orjson.loads(cleaned[start : end + 1] if start != -1 else cleaned)
+            return self.pydantic_object.model_validate(obj)
+        except (orjson.JSONDecodeError, ValidationError) as e:
+            raise OutputParserException(
+                f"Failed to parse {self.pydantic_object.__name__}: {e}", llm_output=text
+            ) from e
+
+    @property
+    def _type(self) -> str:
+        return "fast_pydantic"
+
+
+def with_fast_structured_output(llm: BaseChatModel, schema: Type[T]) -> Runnable:
+    """Drop-in for ``llm.with_structured_output(schema)`` when calls pass ``format="json"``."""
+    return llm | FastPydanticParser(pydantic_object=schema)
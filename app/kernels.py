@@ -0,0 +1,86 @@
+import logging
+
+import numpy as np
+
+from app.logger import setup_logger, timed
+
+
+logger = setup_logger(__name__)
+
+try:
+    from numba import njit
+
+    HAS_NUMBA = True
+except ImportError:
+    HAS_NUMBA = False
+
+    def njit(*args, **kwargs):
+        # Without numba the kernels stay plain Python; callers use the NumPy path instead.
+        return lambda fn: fn
+
+
+@njit(cache=True, fastmath=True)
+def mmr_greedy(sim_q: np.ndarray, sim_dd: np.ndarray, k: int, lambda_mult: float) -> np.ndarray:
+    """Greedy MMR selection over precomputed query/doc and doc/doc similarities."""
+    n = sim_q.shape[0]
+    k = min(k, n)
+    selected = np.empty(k, dtype=np.int64)
+    chosen = np.zeros(n, dtype=np.bool_)
+    max_sim = np.zeros(n, dtype=np.float32)
+    for j in range(k):
+        best = -1
+        best_score = np.float32(0.0)
+        for i in range(n):
+            if chosen[i]:
+                continue
+            if j == 0:
+                score = sim_q[i]
+            else:
+                score = lambda_mult * sim_q[i] - (1 - lambda_mult) * max_sim[i]
+            if best < 0 or score > best_score:
+                best = i
+                best_score = score
+        selected[j] = best
+        chosen[best] = True
+        for i in range(n):
+            if j == 0 or sim_dd[best, i] > max_sim[i]:
+                max_sim[i] = sim_dd[best, i]
+    return selected
+
+
+@njit(cache=True, fastmath=True)
+def bm25plus(
+    tf: np.ndarray,
+    weights: np.ndarray,
+    doc_len: np.ndarray,
+    k1: float,
+    b: float,
+    delta: float,
+) -> np.ndarray:
+    """BM25+ scores for an (N docs, V query terms) term-frequency matrix."""
+    n, v = tf.shape
+    avgdl = doc_len.mean()
+    scores = np.zeros(n, dtype=np.float32)
+    for t in range(v):
+        doc_freq = 0
+        for i in range(n):
+            if tf[i, t] > 0:
+                doc_freq += 1
+        if doc_freq == 0:
+            continue
+        idf = np.log((n + 1) / doc_freq)
+        for i in range(n):
+            norm = k1 * (1 - b + b * doc_len[i] / avgdl)
+            scores[i] += weights[t] * idf * (delta + tf[i, t] * (k1 + 1) / (norm + tf[i, t]))
+    return scores
+
+
+def warm_up_kernels() -> None:
+    """Compile (or load from the on-disk cache) the numba kernels before serving."""
+    if not HAS_NUMBA:
+        logger.info("[warm_up_kernels] numba is not installed, using NumPy reranking")
+        return
+    with timed(logger, "warm_up_kernels", logging.INFO):
+        sims = np.eye(2, dtype=np.float32)
+        mmr_greedy(sims[0], sims, 1, 0.5)
+        bm25plus(sims, np.ones(2, dtype=np.float32), np.ones(2, dtype=np.float32), 1.5, 0.75, 1.0)
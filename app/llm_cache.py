@@ -0,0 +1,57 @@
+from collections import OrderedDict
+from typing import Awaitable, Callable, Optional, Tuple, Type, TypeVar
+
+from pydantic import BaseModel
+
+from app.config import settings
+from app.logger import setup_logger
+
+
+logger = setup_logger(__name__)
+
+T = TypeVar("T", bound=BaseModel)
+
+# Exact-match LRU for structured LLM calls. Entries are stored as JSON so every
+# hit returns a fresh model that callers are free to mutate.
+_memory: "OrderedDict[Tuple[str, str], str]" = OrderedDict()
+
+
+def _normalize(key_text: str) -> str:
+    return " ".join(key_text.lower().split())
+
+
+def _memory_get(fn_name: str, key_text: str, schema: Type[T]) -> Optional[T]:
+    if settings.LLM_MEMORY_CACHE_SIZE <= 0:
+        return None
+    key = (fn_name, _normalize(key_text))
+    cached = _memory.get(key)
+    if cached is None:
+        return None
+    _memory.move_to_end(key)
+    return schema.model_validate_json(cached)
+
+
+def _memory_put(fn_name: str, key_text: str, result: BaseModel) -> None:
+    if settings.LLM_MEMORY_CACHE_SIZE <= 0:
+        return
+    key = (fn_name, _normalize(key_text))
+    _memory[key] = result.model_dump_json()
+    _memory.move_to_end(key)
+    while len(_memory) > settings.LLM_MEMORY_CACHE_SIZE:
+        _memory.popitem(last=False)
+
+
+async def cached_llm_call(
+    fn_name: str,
+    key_text: str,
+    compute: Callable[[], Awaitable[T]],
+    schema: Type[T],
+) -> T:
+    cached = _memory_get(fn_name, key_text, schema)
+    if cached is not None:
+        logger.debug("[llm_cache] %s served from memory", fn_name)
+        return cached
+
+    result = await compute()
+    _memory_put(fn_name, key_text, result)
+    return result
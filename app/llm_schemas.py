@@ -1,6 +1,6 @@
 from enum import Enum
 from typing import Optional, List
-from pydantic import BaseModel, Field, AliasChoices
+from pydantic import BaseModel, Field
 
 
 class DocType(Enum):
@@ -35,27 +35,41 @@ class ChunkMetadata(BaseModel):
     model_config = {"use_enum_values": True}
 
 
-class RankingKeywords(BaseModel):
-    keywords: List[str] = Field(
-        ..., description="Generate exactly 5 financial keywords", min_length=5, max_length=5
+class QueryScope(BaseModel):
+    in_scope: bool = Field(
+        ...,
+        description="Whether the user query is in-scope for financial RAG on SEC filings.",
     )
+    reason: Optional[str] = Field(default=None, description="Short reason for the decision.")
 
 
-class SearchQueries(BaseModel):
-    search_queries: List[str] = Field(
-        validation_alias=AliasChoices("search_queries", "queries"),
-        description="1-3 search queries to retrieve missing information.",
+class QueryAnalysis(BaseModel):
+    scope: QueryScope = Field(description="Whether the query is in-scope")
+    filters: ChunkMetadata = Field(
+        default_factory=ChunkMetadata, description="Metadata filters for retrieval"
+    )
+    subqueries: List[str] = Field(
+        default_factory=list, description="1-3 focused search queries"
+    )
+    keywords: List[str] = Field(
+        default_factory=list, description="5 SEC-filing keywords for BM25 reranking"
     )
 
-    model_config = {"populate_by_name": True}
 
+class SubQueryPlan(BaseModel):
+    query: str = Field(description="The sub-query this plan belongs to")
+    filters: ChunkMetadata = Field(
+        default_factory=ChunkMetadata, description="Metadata filters for retrieval"
+    )
+    keywords: List[str] = Field(
+        default_factory=list, description="5 SEC-filing keywords for BM25 reranking"
+    )
 
-class QueryScope(BaseModel):
-    in_scope: bool = Field(
-        ...,
-        description="Whether the user query is in-scope for financial RAG on SEC filings.",
+
+class BatchSubQueryPlan(BaseModel):
+    items: List[SubQueryPlan] = Field(
+        default_factory=list, description="One retrieval plan per sub-query, in order"
     )
-    reason: Optional[str] = Field(default=None, description="Short reason for the decision.")
 
 
 class GradeDecision(BaseModel):
@@ -63,9 +77,9 @@ class GradeDecision(BaseModel):
         ...,
         description="True if documents are relevant to answer the question, False otherwise.",
     )
-    reasoning: str = Field(
-        ...,
-        description="Brief explanation of why documents are relevant or not.",
+    reasoning: Optional[str] = Field(
+        default=None,
+        description="Optional explanation; the LLM grader is asked to omit it.",
     )
 
 
@@ -89,3 +103,11 @@ class ReflexionAnswer(BaseModel):
         default_factory=list, description="1-3 follow-up search queries if needed"
     )
     is_complete: bool = Field(default=False, description="True if answer is complete")
+
+
+class ReflexionFooter(BaseModel):
+    reflection: Reflection = Field(description="Critical reflection on the answer")
+    search_queries: List[str] = Field(
+        default_factory=list, description="1-3 follow-up search queries if needed"
+    )
+    is_complete: bool = Field(default=False, description="True if answer is complete")
@@ -1,15 +1,29 @@
+import atexit
 import logging
+import logging.handlers
 import os
+import queue
 import sys
+import time
+from contextlib import contextmanager
+from typing import Iterator
 
 from app.config import settings
 
 _configured = False
+_listener = None
+
+
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # The stock prepare() formats the message on the calling thread. The queue
+        # stays in-process, so pass msg/args through for the listener's handlers.
+        return record
 
 
 def setup_logger(name: str) -> logging.Logger:
     """Setup root logger once with configured handlers."""
-    global _configured
+    global _configured, _listener
 
     if not _configured:
         root_logger = logging.getLogger()
@@ -30,7 +44,7 @@ def setup_logger(name: str) -> logging.Logger:
         stream_handler = logging.StreamHandler(sys.stdout)
         stream_handler.setLevel(stream_level)
         stream_handler.setFormatter(formatter)
-        root_logger.addHandler(stream_handler)
+        handlers = [stream_handler]
 
         if settings.LOG_FILE_PATH:
             os.makedirs(os.path.dirname(settings.LOG_FILE_PATH), exist_ok=True)
@@ -38,8 +52,53 @@ def setup_logger(name: str) -> logging.Logger:
             file_handler = logging.FileHandler(settings.LOG_FILE_PATH, mode=file_mode)
             file_handler.setLevel(file_level)
             file_handler.setFormatter(formatter)
-            root_logger.addHandler(file_handler)
+            handlers.append(file_handler)
+
+        # Formatting and write() happen on the listener thread, not the event loop.
+        log_queue = queue.SimpleQueue()
+        root_logger.addHandler(_DeferredQueueHandler(log_queue))
+        _listener = logging.handlers.QueueListener(
+            log_queue, *handlers, respect_handler_level=True
+        )
+        _listener.start()
+        atexit.register(_listener.stop)
 
         _configured = True
 
     return logging.getLogger(name)
+
+
+class Timer:
+    __slots__ = ("start_ns", "end_ns", "detail")
+
+    def __init__(self) -> None:
+        self.start_ns = time.perf_counter_ns()
+        self.end_ns = None
+        self.detail = None
+
+    def describe(self, fmt: str, *args) -> None:
+        """Attach the outcome to the duration line, so each operation logs once."""
+        self.detail = (fmt, args)
+
+    @property
+    def elapsed(self) -> float:
+        """Seconds since start, or the final duration once the block has exited."""
+        end_ns = self.end_ns if self.end_ns is not None else time.perf_counter_ns()
+        return (end_ns - self.start_ns) / 1e9
+
+
+@contextmanager
+def timed(logger: logging.Logger, name: str, level: int = logging.DEBUG) -> Iterator[Timer]:
+    """Time a block on the monotonic clock; log its duration only if it exits cleanly."""
+    timer = Timer()
+    try:
+        yield timer
+    finally:
+        timer.end_ns = time.perf_counter_ns()
+    if logger.isEnabledFor(level):
+        elapsed_ms = (timer.end_ns - timer.start_ns) / 1e6
+        if timer.detail is None:
+            logger.log(level, "[%s] took %.2fms", name, elapsed_ms)
+        else:
+            fmt, args = timer.detail
+            logger.log(level, "[%s] took %.2fms: " + fmt, name, elapsed_ms, *args)
@@ -1,113 +1,221 @@
+import asyncio
+import json
+import logging
 import os
+import shutil
 import time
 from pathlib import Path
 from typing import List
 from contextlib import asynccontextmanager
 
 from fastapi import FastAPI, UploadFile, File, Depends, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
+from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from app.config import settings
-from app.db import init_db_extensions, get_session
-from app.ingest import ingest_pdf_file, ensure_upload_dir
+from app.db import AsyncSessionLocal, init_db_extensions, get_session
+from app.ingest import (
+    ingest_pdf_file,
+    ensure_upload_dir,
+    bulk_load_begin,
+    bulk_load_end,
+    warm_up_converter,
+)
 from app.schemas import IngestResponse, QueryRequest, QueryResponse
-from app.agent import classify_query_scope
+from app.agent import awarm_up_llm
 from app.graph import get_graph
+from app.kernels import warm_up_kernels
+from app.ollama_embed import aclose_client as aclose_embed_client
+from app.web_search import aclose_client as aclose_web_search_client
 from app.logger import setup_logger
 
 
 logger = setup_logger(__name__)
 
-
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     await init_db_extensions()
     ensure_upload_dir()
     os.makedirs(settings.DEBUG_LOG_DIR, exist_ok=True)
+    if settings.INGEST_WARM_UP_CONVERTER:
+        await asyncio.to_thread(warm_up_converter)
+    await asyncio.to_thread(warm_up_kernels)
+    # Compile the LangGraph before serving so the first query does not pay for it.
+    get_graph()
+    if settings.LLM_WARM_UP:
+        await awarm_up_llm()
 
     yield
 
+    await aclose_embed_client()
+    await aclose_web_search_client()
+
 
 app = FastAPI(lifespan=lifespan, title=settings.APP_NAME)
 
 
+def _save_upload(src, dst_path: Path) -> None:
+    with open(dst_path, "wb") as f:
+        shutil.copyfileobj(src, f, length=1 << 20)
+
+
 @app.post("/ingest", response_model=IngestResponse)
 async def ingest_documents(
     files: List[UploadFile] = File(...),
     session: AsyncSession = Depends(get_session),
 ):
     start_time = time.time()
-    logger.info(f"[/ingest] Starting ingest for {len(files)} files")
+    logger.info("[/ingest] Starting ingest for %d files", len(files))
     
     ingested = []
     skipped = []
-    for idx, uploaded_file in enumerate(files, 1):
-        logger.info(f"[/ingest] Processing file {idx}/{len(files)}: {uploaded_file.filename}")
+    bulk_load = len(files) >= settings.INGEST_BULK_LOAD_MIN_FILES
+    if bulk_load:
+        await bulk_load_begin(session)
+    try:
+        for idx, uploaded_file in enumerate(files, 1):
+            logger.info(
+                "[/ingest] Processing file %d/%d: %s",
+                idx,
+                len(files),
+                uploaded_file.filename,
+            )
         
-        if not uploaded_file.filename.lower().endswith(".pdf"):
-            logger.error(f"[/ingest] Rejected non-PDF file: {uploaded_file.filename}")
-            raise HTTPException(status_code=400, detail="Only PDF files are supported.")
+            if not uploaded_file.filename.lower().endswith(".pdf"):
+                logger.error("[/ingest] Rejected non-PDF file: %s", uploaded_file.filename)
+                raise HTTPException(status_code=400, detail="Only PDF files are supported.")
 
-        file_path = Path(settings.UPLOAD_DIR) / uploaded_file.filename
-        logger.debug(f"[/ingest] Saving to {file_path}")
+            file_path = Path(settings.UPLOAD_DIR) / uploaded_file.filename
+            logger.debug("[/ingest] Saving to %s", file_path)
         
-        with open(file_path, "wb") as f:
-            f.write(await uploaded_file.read())
-
-        created, _ = await ingest_pdf_file(session, str(file_path))
-        if created:
-            logger.info(f"[/ingest] Successfully ingested: {uploaded_file.filename}")
-            ingested.append(uploaded_file.filename)
-        else:
-            logger.warning(f"[/ingest] Skipped (already exists): {uploaded_file.filename}")
-            skipped.append(uploaded_file.filename)
+            # Copy in 1 MiB chunks off the event loop instead of reading the whole PDF.
+            await asyncio.to_thread(_save_upload, uploaded_file.file, file_path)
+
+            created, _ = await ingest_pdf_file(session, str(file_path))
+            if created:
+                logger.info("[/ingest] Successfully ingested: %s", uploaded_file.filename)
+                ingested.append(uploaded_file.filename)
+            else:
+                logger.warning("[/ingest] Skipped (already exists): %s", uploaded_file.filename)
+                skipped.append(uploaded_file.filename)
+    finally:
+        if bulk_load:
+            try:
+                await bulk_load_end(session)
+            except SQLAlchemyError as e:
+                # Pages are committed but the indexes are still dropped; do not report success.
+                logger.error("[/ingest] Index rebuild failed: %s", e)
+                await session.rollback()
+                raise HTTPException(
+                    status_code=500,
+                    detail="Files were saved but rebuilding the document_pages indexes failed; "
+                    "run SELECT document_pages_bulk_load_end() to restore them.",
+                ) from e
 
     elapsed = time.time() - start_time
-    logger.info(f"[/ingest] Completed in {elapsed:.2f}s. Ingested: {len(ingested)}, Skipped: {len(skipped)}")
+    logger.info(
+        "[/ingest] Completed in %.2fs. Ingested: %d, Skipped: %d",
+        elapsed,
+        len(ingested),
+        len(skipped),
+    )
     
     return IngestResponse(ingested_files=ingested, skipped_files=skipped)
 
 
+def _select_answer(state: dict) -> str:
+    reflexion_answer = state.get("reflexion_answer", "")
+    final_answer = state.get("final_answer", "")
+    reflexion_complete = state.get("reflexion_complete", False)
+
+    if reflexion_complete and reflexion_answer and len(reflexion_answer) >= len(final_answer):
+        return reflexion_answer
+    return final_answer or reflexion_answer
+
+
 @app.post("/query", response_model=QueryResponse)
 async def query_documents(
     request: QueryRequest, session: AsyncSession = Depends(get_session)
 ):
     start_time = time.time()
-    logger.info(f"[/query] Starting query: {request.query[:100]}... k={request.k}")
+    logger.info("[/query] Starting query: %s... k=%s", request.query[:100], request.k)
     
     k = request.k or settings.DEFAULT_TOP_K
-    logger.debug(f"[/query] Using k={k} (default={settings.DEFAULT_TOP_K})")
+    logger.debug("[/query] Using k=%d (default=%s)", k, settings.DEFAULT_TOP_K)
     
-    scope = classify_query_scope(request.query)
-    if not scope.in_scope:
-        logger.info(f"[/query] Out-of-scope query blocked: {scope.reason}")
-        return QueryResponse(
-            answer="Запрос не относится к финансовым данным из SEC-отчётности. "
-        )
-
     graph = get_graph()
-    initial_state = {"query": request.query, "session": session, "k": k}
+    initial_state = {
+        "query": request.query,
+        "session": session,
+        "k": k,
+    }
     final_state = None
     async for state in graph.astream(initial_state, stream_mode="values"):
         final_state = state
-        logger.debug(f"[/query] Graph state keys: {list(state.keys())}")
-
-    reflexion_answer = (final_state or {}).get("reflexion_answer", "")
-    final_answer = (final_state or {}).get("final_answer", "")
-    reflexion_complete = (final_state or {}).get("reflexion_complete", False)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("[/query] Graph state keys: %s", list(state.keys()))
 
-    if reflexion_complete and reflexion_answer and len(reflexion_answer) >= len(final_answer):
-        answer = reflexion_answer
-    else:
-        answer = final_answer or reflexion_answer
+    answer = _select_answer(final_state or {})
     
     elapsed = time.time() - start_time
-    logger.info(f"[/query] Completed in {elapsed:.2f}s, answer length: {len(answer)} chars")
+    logger.info("[/query] Completed in %.2fs, answer length: %d chars", elapsed, len(answer))
     
     return QueryResponse(answer=answer)
 
 
+def _sse_event(payload: dict) -> str:
+    return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+
+@app.post("/query/stream")
+async def query_documents_stream(request: QueryRequest):
+    logger.info("[/query/stream] Starting query: %s... k=%s", request.query[:100], request.k)
+    k = request.k or settings.DEFAULT_TOP_K
+
+    async def answer_tokens():
+        start_time = time.time()
+        graph = get_graph()
+        streamed = 0
+        final_state = {}
+        # The session must outlive the handler, so it is opened inside the stream body.
+        async with AsyncSessionLocal() as session:
+            initial_state = {
+                "query": request.query,
+                "session": session,
+                "k": k,
+            }
+            async for mode, chunk in graph.astream(
+                initial_state, stream_mode=["messages", "updates"]
+            ):
+                if mode == "updates":
+                    for update in chunk.values():
+                        final_state.update(update or {})
+                    # Refusals come from a node without an LLM call, so send them whole.
+                    refusal = (chunk.get("refuse") or {}).get("final_answer")
+                    if refusal:
+                        streamed += len(refusal)
+                        yield _sse_event({"token": refusal})
+                    continue
+                message, metadata = chunk
+                if metadata.get("langgraph_node") != "answer" or not message.content:
+                    continue
+                streamed += len(message.content)
+                yield _sse_event({"token": message.content})
+        # Same choice as /query: a complete reflexion answer may replace the streamed one.
+        yield _sse_event({"answer": _select_answer(final_state)})
+        yield _sse_event({"done": True})
+
+        elapsed = time.time() - start_time
+        logger.info("[/query/stream] Completed in %.2fs, streamed %s chars", elapsed, streamed)
+
+    return StreamingResponse(
+        answer_tokens(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 @app.get("/health")
 async def health():
     return JSONResponse({"status": "ok"})
@@ -1,7 +1,8 @@
 import uuid
-from sqlalchemy import Column, Integer, String, Text
-from sqlalchemy.dialects.postgresql import UUID
-from pgvector.sqlalchemy import Vector
+from sqlalchemy import Column, Computed, Integer, String, Text
+from sqlalchemy.dialects.postgresql import JSONB, TSVECTOR, UUID
+from sqlalchemy.orm import deferred
+from pgvector.sqlalchemy import HALFVEC
 
 from app.db import Base
 from app.config import settings
@@ -21,4 +22,10 @@ class DocumentPage(Base):
     fiscal_quarter = Column(String, nullable=True, index=True)
 
     content = Column(Text, nullable=False)
-    embedding = Column(Vector(settings.EMBEDDING_DIM), nullable=False)
+    embedding = Column(HALFVEC(settings.EMBEDDING_DIM), nullable=False)
+    # BM25 token counts of the page, precomputed at ingest.
+    term_freqs = Column(JSONB, nullable=True)
+    # Generated by Postgres for the keyword prefilter; never loaded with the row.
+    content_tsv = deferred(
+        Column(TSVECTOR, Computed("to_tsvector('english', content)", persisted=True))
+    )
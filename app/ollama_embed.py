@@ -1,44 +1,125 @@
-import time
-from typing import List
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import List, Optional, Tuple
 import httpx
 
 from app.config import settings
-from app.logger import setup_logger
+from app.embedder import Embedder
+from app.logger import setup_logger, timed
 
 
 logger = setup_logger(__name__)
 
 
+# Query embeddings keyed on (model, text); vectors are stored as tuples so a hit
+# can never be mutated by the caller. Page embeddings at ingest bypass it. Only
+# touched from the event loop, so no lock is needed.
+_query_cache: "OrderedDict[Tuple[str, str], Tuple[float, ...]]" = OrderedDict()
+
+_client: Optional[httpx.AsyncClient] = None
+
+
 def _base_url() -> str:
     return settings.OLLAMA_BASE_URL.rstrip("/")
 
 
-def embed_texts(texts: List[str]) -> List[List[float]]:
-    start_time = time.time()
-    logger.debug(f"[embed_texts] Embedding {len(texts)} texts")
-    
+def get_client() -> httpx.AsyncClient:
+    """Shared keep-alive client for the Ollama embed API, created on first use."""
+    global _client
+    if _client is None:
+        _client = httpx.AsyncClient(
+            base_url=_base_url(),
+            timeout=settings.OLLAMA_TIMEOUT,
+            limits=httpx.Limits(
+                max_keepalive_connections=settings.OLLAMA_MAX_KEEPALIVE_CONNECTIONS,
+                max_connections=settings.OLLAMA_MAX_CONNECTIONS,
+            ),
+        )
+    return _client
+
+
+async def aclose_client() -> None:
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+def _embed_model() -> str:
+    if settings.EMBED_BACKEND == "local":
+        return settings.EMBED_LOCAL_MODEL
+    return settings.OLLAMA_EMBED_MODEL
+
+
+def _cache_get(text: str) -> Optional[Tuple[float, ...]]:
+    key = (_embed_model(), text)
+    cached = _query_cache.get(key)
+    if cached is not None:
+        _query_cache.move_to_end(key)
+    return cached
+
+
+def _cache_put(text: str, embedding: List[float]) -> None:
+    if settings.EMBED_CACHE_SIZE <= 0:
+        return
+    key = (_embed_model(), text)
+    _query_cache[key] = tuple(embedding)
+    _query_cache.move_to_end(key)
+    while len(_query_cache) > settings.EMBED_CACHE_SIZE:
+        _query_cache.popitem(last=False)
+
+
+def _embed_local(texts: List[str]) -> List[List[float]]:
+    return Embedder.get().embed_batch(texts).tolist()
+
+
+async def embed_texts(texts: List[str]) -> List[List[float]]:
+    if settings.EMBED_BACKEND == "local":
+        return await asyncio.to_thread(_embed_local, texts)
+
+    logger.debug("[embed_texts] Embedding %d texts", len(texts))
+
     payload = {
         "model": settings.OLLAMA_EMBED_MODEL,
         "input": texts,
         "keep_alive": "5m",
     }
-    
+
     try:
-        resp = httpx.post(f"{_base_url()}/api/embed", json=payload, timeout=120)
-        resp.raise_for_status()
-        data = resp.json()
-        embeddings = data.get("embeddings", [])
-        
-        elapsed = time.time() - start_time
-        logger.info(f"[embed_texts] Generated {len(embeddings)} embeddings in {elapsed:.2f}s")
-        return embeddings
+        with timed(logger, "embed_texts", logging.INFO) as timer:
+            resp = await get_client().post("/api/embed", json=payload)
+            resp.raise_for_status()
+            embeddings = resp.json().get("embeddings", [])
+            # A short or empty reply would otherwise surface later as a bogus query vector.
+            if len(embeddings) != len(texts) or not all(embeddings):
+                raise ValueError(
+                    f"Ollama returned {len(embeddings)} embeddings for {len(texts)} texts"
+                )
+            timer.describe("%d embeddings", len(embeddings))
     except Exception as e:
-        elapsed = time.time() - start_time
-        logger.error(f"[embed_texts] Failed after {elapsed:.2f}s: {e}")
+        logger.error("[embed_texts] Failed after %.2fs: %s", timer.elapsed, e)
         raise
+    return embeddings
+
+
+async def embed_queries(texts: List[str]) -> List[List[float]]:
+    """Embed query strings, sending only cache misses to the backend."""
+    vectors = [_cache_get(text) for text in texts]
+    misses = list(dict.fromkeys(text for text, vec in zip(texts, vectors) if vec is None))
+    logger.debug(
+        "[embed_queries] %d/%d queries served from cache",
+        len(texts) - len(misses),
+        len(texts),
+    )
+    if misses:
+        fresh = dict(zip(misses, await embed_texts(misses)))
+        for text, embedding in fresh.items():
+            _cache_put(text, embedding)
+        vectors = [vec if vec is not None else fresh[text] for text, vec in zip(texts, vectors)]
+    return [list(vec) for vec in vectors]
 
 
-def embed_query(text: str) -> List[float]:
-    logger.debug(f"[embed_query] Embedding query: {text[:100]}...")
-    embeddings = embed_texts([text])
-    return embeddings[0] if embeddings else []
+async def embed_query(text: str) -> List[float]:
+    logger.debug("[embed_query] Embedding query: %s...", text[:100])
+    return (await embed_queries([text]))[0]
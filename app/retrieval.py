@@ -1,44 +1,86 @@
+import asyncio
+import hashlib
+import logging
 import os
 import re
 import time
+from collections import Counter
+from functools import lru_cache
 import numpy as np
-from typing import List, Dict, Any
+from typing import Iterator, List, Dict, Any, Optional, Tuple
 
-from rank_bm25 import BM25Plus
-from sqlalchemy import select, or_
+from sqlalchemy import func, literal, select, text, union_all
 from sqlalchemy.ext.asyncio import AsyncSession
-from langchain_core.vectorstores.utils import maximal_marginal_relevance
 
+from app import kernels
 from app.config import settings
+from app.kernels import HAS_NUMBA
 from app.models import DocumentPage
-from app.ollama_embed import embed_query
+from app.ollama_embed import embed_queries, embed_query
 from app.logger import setup_logger
 
 
 logger = setup_logger(__name__)
 
 
+_HEADING_RE = re.compile(r"^#+\s+")
+
+
+def _paragraphs(text: str) -> Iterator[str]:
+    """Yield blank-line separated blocks of text, stripped, in a single pass over lines."""
+    lines: List[str] = []
+    for line in text.splitlines():
+        if line:
+            lines.append(line)
+        elif lines:
+            yield "\n".join(lines).strip()
+            lines = []
+    if lines:
+        yield "\n".join(lines).strip()
+
+
 def extract_headings_with_content(text: str) -> List[str]:
     chunks = []
-    sections = text.split("\n\n")
-    i = 0
-    while i < len(sections):
-        section = sections[i].strip()
-        if re.match(r"^#+\s+", section):
-            heading = section
-            if i + 1 < len(sections):
-                next_content = sections[i + 1].strip()
-                chunk = f"{heading}\n\n{next_content}"
-                i += 2
-            else:
-                chunk = heading
-                i += 1
-            chunks.append(chunk)
-        else:
-            i += 1
+    paragraphs = _paragraphs(text)
+    for paragraph in paragraphs:
+        if _HEADING_RE.match(paragraph):
+            body = next(paragraphs, None)
+            chunks.append(paragraph if body is None else f"{paragraph}\n\n{body}")
     return chunks
 
 
+def page_term_freqs(content: str) -> Dict[str, int]:
+    chunks = extract_headings_with_content(content)
+    combined = " ".join(chunks) if chunks else content
+    return dict(Counter(combined.lower().split(" ")))
+
+
+BM25_K1 = 1.5
+BM25_B = 0.75
+BM25_DELTA = 1.0
+
+
+def bm25plus_scores(term_freqs: List[Dict[str, int]], query_tokens: List[str]) -> np.ndarray:
+    """BM25+ scores (same formula and defaults as rank_bm25.BM25Plus) over query terms only."""
+    query_counts = Counter(query_tokens)
+    terms = list(query_counts)
+    weights = np.fromiter(query_counts.values(), dtype=np.float32, count=len(terms))
+    tf = np.array([[freqs.get(t, 0) for t in terms] for freqs in term_freqs], dtype=np.float32)
+    doc_len = np.fromiter(
+        (sum(freqs.values()) for freqs in term_freqs), dtype=np.float32, count=len(term_freqs)
+    )
+
+    if HAS_NUMBA:
+        return kernels.bm25plus(tf, weights, doc_len, BM25_K1, BM25_B, BM25_DELTA)
+
+    doc_freq = np.count_nonzero(tf, axis=0)
+    idf = np.log((len(term_freqs) + 1) / np.maximum(doc_freq, 1))
+    idf[doc_freq == 0] = 0.0
+    norm = BM25_K1 * (1 - BM25_B + BM25_B * doc_len / doc_len.mean())
+    per_term = idf * (BM25_DELTA + tf * (BM25_K1 + 1) / (norm[:, None] + tf))
+    return per_term @ weights
+
+
 def rank_documents_by_keywords(
     docs: List[DocumentPage], keywords: List[str], k: int
 ) -> List[DocumentPage]:
@@ -46,60 +88,98 @@ def rank_documents_by_keywords(
         return docs
 
     query_tokens = " ".join(keywords).lower().split(" ")
-    doc_chunks = []
-    for doc in docs:
-        chunks = extract_headings_with_content(doc.content)
-        combined = " ".join(chunks) if chunks else doc.content
-        doc_chunks.append(combined.lower().split(" "))
+    term_freqs = [
+        doc.term_freqs if doc.term_freqs is not None else page_term_freqs(doc.content)
+        for doc in docs
+    ]
+    scores = bm25plus_scores(term_freqs, query_tokens)
+    ranked_indices = np.argsort(-scores, kind="stable")[:k]
+    return [docs[i] for i in ranked_indices]
 
-    bm25 = BM25Plus(doc_chunks)
-    scores = bm25.get_scores(query_tokens)
-    ranked_indices = sorted(range(len(scores)), key=lambda i: scores[i], reverse=True)
-    return [docs[i] for i in ranked_indices[:k]]
+
+def _l2_normalize(vecs: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vecs, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vecs / norms
 
 
 def mmr(
-    query_vec: List[float],
-    doc_vecs: List[List[float]],
+    query_vec: np.ndarray,
+    doc_vecs: np.ndarray,
     k: int,
     lambda_mult: float = 0.5,
 ) -> List[int]:
-    if not doc_vecs:
+    """Maximal marginal relevance over an (N, D) matrix with one GEMV per pick."""
+    if len(doc_vecs) == 0 or k <= 0:
         return []
-    return maximal_marginal_relevance(
-        query_embedding=np.array(query_vec, dtype=np.float32),
-        embedding_list=doc_vecs,
-        k=k,
-        lambda_mult=lambda_mult,
-    )
+    A = _l2_normalize(np.asarray(doc_vecs, dtype=np.float32))
+    q = _l2_normalize(np.asarray(query_vec, dtype=np.float32))
+    sim_q = A @ q
+    if HAS_NUMBA:
+        return kernels.mmr_greedy(sim_q, A @ A.T, k, lambda_mult).tolist()
+
+    selected = [int(np.argmax(sim_q))]
+    chosen = np.zeros(len(A), dtype=bool)
+    chosen[selected[0]] = True
+    # Running max similarity of every doc to the selected set, updated in O(N·D) per pick.
+    max_sim = A @ A[selected[0]]
+    for _ in range(min(k, len(A)) - 1):
+        scores = lambda_mult * sim_q - (1 - lambda_mult) * max_sim
+        scores[chosen] = -np.inf
+        idx = int(np.argmax(scores))
+        selected.append(idx)
+        chosen[idx] = True
+        np.maximum(max_sim, A @ A[idx], out=max_sim)
+    return selected
+
+
+_FILTER_COLUMNS = (
+    ("company_name", DocumentPage.company_name),
+    ("doc_type", DocumentPage.doc_type),
+    ("fiscal_year", DocumentPage.fiscal_year),
+    ("fiscal_quarter", DocumentPage.fiscal_quarter),
+)
 
 
-async def build_filters(
-    filters: Dict[str, Any], ranking_keywords: List[str]
-) -> List[Any]:
-    logger.debug(f"[build_filters] Input filters: {filters}, keywords: {ranking_keywords}")
+@lru_cache(maxsize=256)
+def _keyword_tsquery(keywords: Tuple[str, ...]) -> str:
+    # websearch syntax: each keyword is a quoted phrase, any of them may match.
+    return " OR ".join('"' + kw.replace('"', " ") + '"' for kw in keywords)
+
+
+def build_filters(filters: Dict[str, Any], ranking_keywords: List[str]) -> List[Any]:
+    if not filters and not ranking_keywords:
+        return []
+    logger.debug("[build_filters] Input filters: %s, keywords: %s", filters, ranking_keywords)
     
     conditions = []
     if filters:
-        if filters.get("company_name"):
-            conditions.append(DocumentPage.company_name == filters["company_name"])
-        if filters.get("doc_type"):
-            conditions.append(DocumentPage.doc_type == filters["doc_type"])
-        if filters.get("fiscal_year"):
-            conditions.append(DocumentPage.fiscal_year == filters["fiscal_year"])
-        if filters.get("fiscal_quarter"):
-            conditions.append(DocumentPage.fiscal_quarter == filters["fiscal_quarter"])
+        for key, column in _FILTER_COLUMNS:
+            if filters.get(key):
+                conditions.append(column == filters[key])
 
     if ranking_keywords:
-        keyword_conditions = [
-            DocumentPage.content.ilike(f"%{kw}%") for kw in ranking_keywords
-        ]
-        conditions.append(or_(*keyword_conditions))
+        # Only the query string is cached; the clause must be fresh for every statement.
+        tsquery = _keyword_tsquery(tuple(sorted(set(ranking_keywords))))
+        conditions.append(
+            DocumentPage.content_tsv.op("@@")(func.websearch_to_tsquery("english", tsquery))
+        )
 
-    logger.debug(f"[build_filters] Built {len(conditions)} SQL conditions")
+    logger.debug("[build_filters] Built %d SQL conditions", len(conditions))
     return conditions
 
 
+async def _prepare_ann_query(session: AsyncSession, fetch_k: int) -> None:
+    # Scoped to the current transaction: force the vector index path for the ANN query.
+    await session.execute(text("SET LOCAL enable_seqscan = off"))
+    # HNSW returns at most ef_search rows, so it must cover the candidate pool.
+    # set_config(..., true) is SET LOCAL with a bind parameter.
+    await session.execute(
+        text("SELECT set_config('hnsw.ef_search', :ef_search, true)"),
+        {"ef_search": str(max(settings.HNSW_EF_SEARCH, fetch_k))},
+    )
+
+
 async def search_docs(
     session: AsyncSession,
     query: str,
@@ -107,64 +187,209 @@ async def search_docs(
     ranking_keywords: List[str],
     k: int,
     fetch_k: int,
-) -> List[DocumentPage]:
+    query_vec: Optional[List[float]] = None,
+) -> List[Tuple[DocumentPage, float]]:
     start_time = time.time()
-    logger.debug(f"[search_docs] Query: {query}, k={k}, fetch_k={fetch_k}")
+    logger.debug("[search_docs] Query: %s, k=%d, fetch_k=%s", query, k, fetch_k)
     
-    embed_start = time.time()
-    query_vec = embed_query(query)
-    embed_elapsed = time.time() - embed_start
-    logger.debug(f"[search_docs] Query embedding took {embed_elapsed:.2f}s")
+    if query_vec is None:
+        embed_start = time.time()
+        query_vec = await embed_query(query)
+        embed_elapsed = time.time() - embed_start
+        logger.debug("[search_docs] Query embedding took %.2fs", embed_elapsed)
 
-    conditions = await build_filters(filters, ranking_keywords)
-    stmt = select(DocumentPage).where(*conditions).order_by(
-        DocumentPage.embedding.cosine_distance(query_vec)
-    ).limit(fetch_k)
+    conditions = build_filters(filters, ranking_keywords)
+    distance = DocumentPage.embedding.cosine_distance(query_vec)
+    # Phase 1 pulls only ids and vectors for the whole candidate pool; page text is
+    # loaded afterwards for the k pages MMR keeps.
+    stmt = (
+        select(DocumentPage.id, DocumentPage.embedding, distance.label("distance"))
+        .where(*conditions)
+        .order_by(distance)
+        .limit(fetch_k)
+    )
 
     db_start = time.time()
-    rows = (await session.execute(stmt)).scalars().all()
+    await _prepare_ann_query(session, fetch_k)
+    candidates = (await session.execute(stmt)).all()
     db_elapsed = time.time() - db_start
-    logger.info(f"[search_docs] DB query returned {len(rows)} rows in {db_elapsed:.2f}s")
+    logger.info("[search_docs] DB query returned %d rows in %.2fs", len(candidates), db_elapsed)
     
-    if not rows:
+    if not candidates:
         logger.warning("[search_docs] No documents found matching filters/keywords")
         return []
 
+    selected = _mmr_candidates(candidates, query_vec, k)
+    pages = await _load_pages(session, [doc_id for doc_id, _ in selected])
+    reranked = _rerank(pages, selected, ranking_keywords, k)
+
+    total_elapsed = time.time() - start_time
+    logger.info(
+        "[search_docs] Total search took %.2fs, returning %d docs",
+        total_elapsed,
+        len(reranked),
+    )
+
+    return reranked
+
+
+def _mmr_candidates(
+    candidates: List[Tuple[Any, Any, float]],
+    query_vec: List[float],
+    k: int,
+) -> List[Tuple[Any, float]]:
+    """Run MMR over (id, embedding, distance) rows and return the kept (id, distance)."""
     mmr_start = time.time()
-    doc_vecs = [doc.embedding for doc in rows]
-    selected = mmr(query_vec, doc_vecs, k=k)
-    mmr_docs = [rows[i] for i in selected]
+    doc_vecs = np.array([embedding.to_numpy() for _, embedding, _ in candidates], dtype=np.float32)
+    selected = [(candidates[i][0], candidates[i][2]) for i in mmr(query_vec, doc_vecs, k=k)]
     mmr_elapsed = time.time() - mmr_start
-    logger.debug(f"[search_docs] MMR selected {len(mmr_docs)} docs in {mmr_elapsed:.2f}s")
+    logger.debug("[search_docs] MMR selected %d docs in %.2fs", len(selected), mmr_elapsed)
+    return selected
+
+
+async def _load_pages(session: AsyncSession, ids: List[Any]) -> Dict[Any, DocumentPage]:
+    if not ids:
+        return {}
+    result = await session.execute(select(DocumentPage).where(DocumentPage.id.in_(ids)))
+    return {doc.id: doc for doc in result.scalars()}
+
+
+def _rerank(
+    pages: Dict[Any, DocumentPage],
+    selected: List[Tuple[Any, float]],
+    ranking_keywords: List[str],
+    k: int,
+) -> List[Tuple[DocumentPage, float]]:
+    mmr_docs = [pages[doc_id] for doc_id, _ in selected if doc_id in pages]
+    distances = dict(selected)
 
     rerank_start = time.time()
     reranked = rank_documents_by_keywords(mmr_docs, ranking_keywords, k=k)
     rerank_elapsed = time.time() - rerank_start
-    logger.debug(f"[search_docs] BM25 reranking took {rerank_elapsed:.2f}s")
-    
+    logger.debug("[search_docs] BM25 reranking took %.2fs", rerank_elapsed)
+
+    return [(doc, distances[doc.id]) for doc in reranked]
+
+
+async def search_docs_batch(
+    session: AsyncSession,
+    searches: List[Tuple[str, Dict[str, Any], List[str]]],
+    k: int,
+    fetch_k: int,
+) -> List[List[Tuple[DocumentPage, float]]]:
+    if not searches:
+        return []
+
+    start_time = time.time()
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("[search_docs_batch] Queries: %s", [query for query, _, _ in searches])
+
+    embed_start = time.time()
+    query_vecs = await embed_queries([query for query, _, _ in searches])
+    embed_elapsed = time.time() - embed_start
+    logger.debug("[search_docs_batch] Query embeddings took %.2fs", embed_elapsed)
+
+    # One UNION ALL statement: each member keeps its own filters and fetch_k limit.
+    members = []
+    for qid, ((_, filters, ranking_keywords), query_vec) in enumerate(zip(searches, query_vecs)):
+        conditions = build_filters(filters, ranking_keywords)
+        distance = DocumentPage.embedding.cosine_distance(query_vec)
+        ranked = (
+            select(
+                DocumentPage.id,
+                DocumentPage.embedding,
+                literal(qid).label("qid"),
+                distance.label("distance"),
+            )
+            .where(*conditions)
+            .order_by(distance)
+            .limit(fetch_k)
+            .subquery()
+        )
+        members.append(select(ranked))
+    combined = union_all(*members).subquery()
+    stmt = select(combined.c.id, combined.c.embedding, combined.c.qid, combined.c.distance)
+
+    db_start = time.time()
+    await _prepare_ann_query(session, fetch_k)
+    result = (await session.execute(stmt)).all()
+    candidates_by_query: List[List[Tuple[Any, Any, float]]] = [[] for _ in searches]
+    for doc_id, embedding, qid, distance in result:
+        candidates_by_query[qid].append((doc_id, embedding, distance))
+    db_elapsed = time.time() - db_start
+    logger.info(
+        "[search_docs_batch] DB query returned %d rows for %d queries in %.2fs",
+        len(result),
+        len(searches),
+        db_elapsed,
+    )
+
+    selected_by_query = [
+        _mmr_candidates(candidates, query_vec, k) if candidates else []
+        for candidates, query_vec in zip(candidates_by_query, query_vecs)
+    ]
+    # Pages shared between follow-up queries are fetched once.
+    pages = await _load_pages(
+        session,
+        list({doc_id for selected in selected_by_query for doc_id, _ in selected}),
+    )
+
+    results = []
+    for (query, _, ranking_keywords), selected in zip(searches, selected_by_query):
+        if not selected:
+            logger.warning("[search_docs_batch] No documents found for query: %s", query)
+            results.append([])
+            continue
+        results.append(_rerank(pages, selected, ranking_keywords, k))
+
     total_elapsed = time.time() - start_time
-    logger.info(f"[search_docs] Total search took {total_elapsed:.2f}s, returning {len(reranked)} docs")
-    
-    return reranked
+    logger.info("[search_docs_batch] Total search took %.2fs", total_elapsed)
+    return results
+
+
+# Positional %-formatting: no per-call kwargs dict, one allocation per page.
+_DOC_TEMPLATE = (
+    "--- Document %d ---\n"
+    "company_name: %s\n"
+    "doc_type: %s\n"
+    "fiscal_year: %s\n"
+    "fiscal_quarter: %s\n"
+    "page: %s\n"
+    "source_file: %s\n"
+    "file_hash: %s\n"
+    "\n"
+    "Content:\n"
+    "%s\n"
+)
+
+
+def format_docs(docs: List[DocumentPage]) -> str:
+    return "\n".join(
+        _DOC_TEMPLATE
+        % (
+            i,
+            doc.company_name,
+            doc.doc_type,
+            doc.fiscal_year,
+            doc.fiscal_quarter,
+            doc.page,
+            doc.source_file,
+            doc.file_hash,
+            doc.content,
+        )
+        for i, doc in enumerate(docs, 1)
+    )
+
+
+def _write_text(path: str, data: str) -> None:
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(data)
 
 
-def write_debug_log(docs: List[DocumentPage]) -> None:
-    os.makedirs(settings.DEBUG_LOG_DIR, exist_ok=True)
-    lines = []
-    for i, doc in enumerate(docs, 1):
-        lines.append(f"--- Document {i} ---")
-        lines.append(f"company_name: {doc.company_name}")
-        lines.append(f"doc_type: {doc.doc_type}")
-        lines.append(f"fiscal_year: {doc.fiscal_year}")
-        lines.append(f"fiscal_quarter: {doc.fiscal_quarter}")
-        lines.append(f"page: {doc.page}")
-        lines.append(f"source_file: {doc.source_file}")
-        lines.append(f"file_hash: {doc.file_hash}")
-        lines.append("")
-        lines.append("Content:")
-        lines.append(doc.content)
-        lines.append("")
-
-    log_path = os.path.join(settings.DEBUG_LOG_DIR, "retrieved_reranked_docs.md")
-    with open(log_path, "w", encoding="utf-8") as f:
-        f.write("\n".join(lines))
+async def write_debug_log(query: str, docs_text: str) -> None:
+    """Dump the formatted docs (the same text the LLM sees) for inspection."""
+    # DEBUG_LOG_DIR is created once in the app lifespan. Sub-queries retrieve
+    # concurrently, so each query gets its own file instead of overwriting one.
+    query_id = hashlib.sha1(query.encode("utf-8")).hexdigest()[:12]
+    log_path = os.path.join(settings.DEBUG_LOG_DIR, f"retrieved_reranked_docs_{query_id}.md")
+    await asyncio.to_thread(_write_text, log_path, f"# Query: {query}\n\n{docs_text}")
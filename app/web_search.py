@@ -1,7 +1,9 @@
+import asyncio
 import time
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Optional
 
-import requests
+import httpx
+import orjson
 
 from app.config import settings
 from app.logger import setup_logger
@@ -9,13 +11,46 @@ from app.logger import setup_logger
 
 logger = setup_logger(__name__)
 
+_client: Optional[httpx.AsyncClient] = None
+
+
+def get_client() -> httpx.AsyncClient:
+    global _client
+    if _client is None:
+        _client = httpx.AsyncClient(timeout=settings.WEB_SEARCH_TIMEOUT)
+    return _client
+
+
+async def aclose_client() -> None:
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+async def _read_capped(response: httpx.Response, max_bytes: int) -> bytes:
+    buf = bytearray()
+    async for chunk in response.aiter_bytes():
+        buf += chunk
+        if len(buf) > max_bytes:
+            raise ValueError(f"response exceeds {max_bytes} bytes")
+    return bytes(buf)
+
+
+async def _post_capped(headers: Dict[str, str], body: Dict[str, Any]) -> bytes:
+    async with get_client().stream(
+        "POST", settings.WEB_SEARCH_ENDPOINT, headers=headers, json=body
+    ) as response:
+        response.raise_for_status()
+        return await _read_capped(response, settings.WEB_SEARCH_MAX_BYTES)
+
 
 def _extract_results(payload: Dict[str, Any]) -> List[Dict[str, str]]:
     results = payload.get("results")
     return results if isinstance(results, list) else []
 
 
-def web_search(query: str) -> str:
+async def web_search(query: str) -> str:
     start_time = time.time()
     if not settings.WEB_SEARCH_ENDPOINT or not settings.WEB_SEARCH_API_KEY:
         logger.warning("[web_search] Missing endpoint or API key, skipping web search")
@@ -32,14 +67,9 @@ def web_search(query: str) -> str:
     }
 
     try:
-        response = requests.post(
-            settings.WEB_SEARCH_ENDPOINT,
-            headers=headers,
-            json=body,
-            timeout=settings.WEB_SEARCH_TIMEOUT,
-        )
-        response.raise_for_status()
-        payload = response.json()
+        # httpx timeouts are per read; the deadline also bounds a slowly trickling body.
+        data = await asyncio.wait_for(_post_capped(headers, body), settings.WEB_SEARCH_TIMEOUT)
+        payload = orjson.loads(data)
         results = _extract_results(payload)
 
         snippets = []
@@ -52,9 +82,9 @@ def web_search(query: str) -> str:
             snippets.append(f"- {title}\n{snippet}\n{link}".strip())
 
         elapsed = time.time() - start_time
-        logger.info(f"[web_search] Retrieved {len(snippets)} results in {elapsed:.2f}s")
+        logger.info("[web_search] Retrieved %d results in %.2fs", len(snippets), elapsed)
         return "\n\n".join(snippets)
     except Exception as e:
         elapsed = time.time() - start_time
-        logger.warning(f"[web_search] Failed in {elapsed:.2f}s: {e}")
+        logger.warning("[web_search] Failed in %.2fs: %s", elapsed, e)
         return ""